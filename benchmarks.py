@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# Benchmarks for the request path and the ORM.
+#
+#   python benchmarks.py                                 run everything, print the results
+#   python benchmarks.py --output bench.json             also save them as JSON
+#   python benchmarks.py --baseline bench.json           compare with an earlier run
+#   python benchmarks.py --baseline bench.json --threshold 0.1
+#
+# When a baseline is given, the run exits with status 1 if any benchmark got
+# slower than the baseline by more than the threshold (a fraction, 0.2 = 20%).
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from webob import Request
+
+from tomapi import codecs
+from tomapi.api import API
+from tomapi.middleware import Middleware
+from tomapi.orm import Database, Table, Column, ForeignKey
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = {}
+
+
+# Registers a benchmark. The decorated function does its setup and returns
+# the callable that is actually timed.
+def benchmark(name):
+    def wrapper(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return wrapper
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def _make_api(**kwargs):
+    return API(
+        templates_dir=os.path.join(HERE, "templates"),
+        static_dir=os.path.join(HERE, "static"),
+        **kwargs
+    )
+
+
+def _call(api, path):
+    environ = Request.blank(path).environ
+    return lambda: b"".join(api(dict(environ), _start_response))
+
+
+def _routes(count):
+    api = _make_api()
+    for i in range(count):
+        api.add_route(f"/route{i}/{{id}}", lambda req, resp, id: None)
+    # The last route is the worst case for the lookup
+    return lambda: api.find_handler(f"/route{count - 1}/42")
+
+
+@benchmark("find_handler_10_routes")
+def bench_find_handler_10():
+    return _routes(10)
+
+
+@benchmark("find_handler_100_routes")
+def bench_find_handler_100():
+    return _routes(100)
+
+
+@benchmark("find_handler_1000_routes")
+def bench_find_handler_1000():
+    return _routes(1000)
+
+
+@benchmark("wsgi_text")
+def bench_wsgi_text():
+    api = _make_api()
+
+    @api.route("/text")
+    def text(req, resp):
+        resp.text = "Hello"
+
+    return _call(api, "/text")
+
+
+@benchmark("wsgi_text_with_middleware")
+def bench_wsgi_text_with_middleware():
+    api = _make_api()
+
+    class NoopMiddleware(Middleware):
+        pass
+
+    for _ in range(3):
+        api.add_middleware(NoopMiddleware)
+
+    @api.route("/text")
+    def text(req, resp):
+        resp.text = "Hello"
+
+    return _call(api, "/text")
+
+
+@benchmark("wsgi_text_with_metrics")
+def bench_wsgi_text_with_metrics():
+    api = _make_api()
+    api.enable_metrics()
+
+    @api.route("/text")
+    def text(req, resp):
+        resp.text = "Hello"
+
+    return _call(api, "/text")
+
+
+@benchmark("wsgi_json")
+def bench_wsgi_json():
+    api = _make_api()
+
+    @api.route("/json")
+    def json_handler(req, resp):
+        resp.json = {"items": [{"id": i, "name": f"item {i}"} for i in range(20)]}
+
+    return _call(api, "/json")
+
+
+@benchmark("wsgi_html")
+def bench_wsgi_html():
+    api = _make_api()
+
+    @api.route("/html")
+    def html(req, resp):
+        resp.html = "<html><body><h1>Hello</h1></body></html>"
+
+    return _call(api, "/html")
+
+
+@benchmark("wsgi_template")
+def bench_wsgi_template():
+    api = _make_api()
+
+    @api.route("/template")
+    def template(req, resp):
+        resp.html = api.template("index.html", context={"title": "Title", "name": "Name"})
+
+    return _call(api, "/template")
+
+
+@benchmark("wsgi_static_file")
+def bench_wsgi_static_file():
+    return _call(_make_api(), "/static/style.css")
+
+
+# Cold start: a fresh interpreter importing the framework
+@benchmark("import_tomapi_api")
+def bench_import_tomapi_api():
+    command = [sys.executable, "-c", "import tomapi.api"]
+    return lambda: subprocess.run(command, capture_output=True, check=True, cwd=HERE)
+
+
+class Author(Table):
+    name = Column(str)
+    age = Column(int)
+
+
+class Book(Table):
+    title = Column(str)
+    published = Column(bool)
+    author = ForeignKey(Author)
+
+
+# The benchmark databases live here for the length of the run, it is removed at exit
+DATABASE_DIR = tempfile.TemporaryDirectory(prefix="tomapi-bench-")
+_database_count = itertools.count()
+
+
+def _database(rows=0):
+    path = os.path.join(DATABASE_DIR.name, f"bench{next(_database_count)}.db")
+    db = Database(path)
+    db.create(Author)
+    db.create(Book)
+    for i in range(rows):
+        author = Author(name=f"Author {i}", age=i)
+        db.save(author)
+        db.save(Book(title=f"Book {i}", published=True, author=author))
+    return db
+
+
+@benchmark("orm_save")
+def bench_orm_save():
+    db = _database()
+    return lambda: db.save(Author(name="John", age=30))
+
+
+@benchmark("orm_save_with_foreign_key")
+def bench_orm_save_with_foreign_key():
+    db = _database(rows=1)
+    author = db.get(Author, 1)
+    return lambda: db.save(Book(title="Book", published=True, author=author))
+
+
+@benchmark("orm_get")
+def bench_orm_get():
+    db = _database(rows=1)
+    return lambda: db.get(Author, 1)
+
+
+@benchmark("orm_get_with_foreign_key")
+def bench_orm_get_with_foreign_key():
+    db = _database(rows=1)
+    return lambda: db.get(Book, 1)
+
+
+@benchmark("orm_all_100")
+def bench_orm_all():
+    db = _database(rows=100)
+    return lambda: db.all(Author)
+
+
+@benchmark("orm_all_100_with_foreign_key")
+def bench_orm_all_with_foreign_key():
+    db = _database(rows=100)
+    return lambda: db.all(Book)
+
+
+# A typical API payload: a page of records with nested lists and mixed types
+PAYLOAD = {
+    "count": 100,
+    "next": "/books?page=2",
+    "results": [
+        {
+            "id": i,
+            "title": f"Book number {i}",
+            "published": i % 2 == 0,
+            "rating": i / 7,
+            "tags": ["python", "web", "framework"],
+            "author": {"id": i % 10, "name": f"Author {i % 10}", "age": 30 + i % 40},
+        }
+        for i in range(100)
+    ],
+}
+
+
+def _register_codec_benchmarks():
+    for content_type in codecs.available_content_types():
+        name = content_type.split("/")[-1]
+        encode, decode = codecs.get_codec(content_type)
+        body = encode(PAYLOAD)
+        benchmark(f"encode_{name}")(lambda encode=encode: lambda: encode(PAYLOAD))
+        benchmark(f"decode_{name}")(lambda decode=decode, body=body: lambda: decode(body))
+
+
+_register_codec_benchmarks()
+
+
+def payload_sizes():
+    return {
+        content_type: len(codecs.get_codec(content_type)[0](PAYLOAD))
+        for content_type in codecs.available_content_types()
+    }
+
+
+# Time `func` in `repeat` rounds that each last at least `min_time` seconds
+# and keep the fastest round, which is the least disturbed by noise.
+def measure(func, repeat=5, min_time=0.1):
+    func()
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+
+    return {"best": min(timings), "mean": sum(timings) / len(timings), "number": number}
+
+
+def run(names, repeat, min_time):
+    results = {}
+    for name in names:
+        results[name] = measure(BENCHMARKS[name](), repeat=repeat, min_time=min_time)
+        print(f"{name:<40} {results[name]['best'] * 1e6:12.2f} us/op")
+    return results
+
+
+# Returns the benchmarks whose best time is slower than the baseline by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result["best"] / baseline[name]["best"] - 1
+        marker = "REGRESSION" if change > threshold else ""
+        print(f"{name:<40} {change * 100:+10.1f}% {marker}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the tomapi benchmarks.")
+    parser.add_argument("-k", "--filter", default="", help="only run benchmarks containing this string")
+    parser.add_argument("-o", "--output", help="save the results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("-t", "--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.1, help="minimum seconds per round")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run(names, args.repeat, args.min_time)
+
+    sizes = payload_sizes()
+    if any(name.startswith(("encode_", "decode_")) for name in names):
+        print()
+        for content_type, size in sizes.items():
+            print(f"{content_type + ' payload':<40} {size:12d} bytes")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "payload_sizes": sizes,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
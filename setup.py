@@ -11,7 +11,7 @@ NAME = "tomapi"
 DESCRIPTION = "tomapi Python Web Framework built for learning purposes."
 EMAIL = "tomfordweb@gmail.com"
 AUTHOR = "Tom Ford"
-REQUIRES_PYTHON = ">=3.6.0"
+REQUIRES_PYTHON = ">=3.9.0"
 VERSION = "0.0.2"
 
 # Which packages are required for this module to be executed?
@@ -24,6 +24,12 @@ REQUIRED = [
     "whitenoise==4.1.4",
 ]
 
+# What packages are optional?
+EXTRAS = {
+    "msgpack": ["msgpack"],
+    "cbor": ["cbor2"],
+}
+
 # The rest you shouldn't have to touch too much :)
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -58,10 +64,12 @@ setup(
     python_requires=REQUIRES_PYTHON,
     packages=find_packages(exclude=["test_*"]),
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     include_package_data=True,
+    entry_points={"console_scripts": ["tomapi=tomapi.cli:main"]},
     license="MIT",
     classifiers=[
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.9",
     ],
     setup_requires=["wheel"],
 )
@@ -1,7 +1,26 @@
+from io import BytesIO
+import asyncio
+import gc
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
+import requests
+from webob import Request
 
+from tomapi.admission import AdmissionControlMiddleware
 from tomapi.api import API
+from tomapi.body import RequestBody, RequestEntityTooLarge
+from tomapi.cli import parse_mix_entry
+from tomapi.coalesce import SingleFlight
+from tomapi.loadtest import LoadTest, LoadTestResult
 from tomapi.middleware import Middleware
+from tomapi.orm import Column, Table
 
 FILE_DIR = "css"
 FILE_NAME = "main.css"
@@ -237,3 +256,782 @@ def manually_setting_body(api,client):
 
 
 
+
+
+def test_metrics_are_disabled_by_default(api, client):
+    assert api.metrics is None
+    assert client.get("http://testserver/metrics").status_code == 404
+
+
+def test_metrics_endpoint(api, client):
+    api.enable_metrics()
+
+    @api.route("/hello/{name}")
+    def hello(req, resp, name):
+        resp.html = api.template("index.html", context={"title": "Title", "name": name})
+
+    client.get("http://testserver/hello/tom")
+    client.get("http://testserver/hello/ashley")
+    client.get("http://testserver/nowhere")
+
+    response = client.get("http://testserver/metrics")
+    body = response.text
+
+    assert response.status_code == 200
+    assert 'tomapi_requests_total{route="/hello/{name}",method="GET",status="200"} 2' in body
+    assert 'tomapi_requests_total{route="<unmatched>",method="GET",status="404"} 1' in body
+    assert 'tomapi_request_duration_seconds_count{route="/hello/{name}"} 2' in body
+    assert 'tomapi_request_duration_seconds_bucket{route="/hello/{name}",le="+Inf"} 2' in body
+    assert "tomapi_requests_in_flight 1" in body
+    for phase in ("routing", "middleware", "handler", "template"):
+        assert f'tomapi_phase_calls_total{{phase="{phase}"}}' in body
+
+
+def test_metrics_fold_the_shards_of_finished_threads(api, client):
+    metrics = api.enable_metrics()
+
+    @api.route("/hello")
+    def hello(req, resp):
+        resp.text = "hello"
+
+    for _ in range(20):
+        thread = threading.Thread(target=client.get, args=("http://testserver/hello",))
+        thread.start()
+        thread.join()
+    gc.collect()
+
+    assert len(metrics._shards) == 0
+    body = client.get("http://testserver/metrics").text
+    assert 'tomapi_requests_total{route="/hello",method="GET",status="200"} 20' in body
+    assert 'tomapi_phase_calls_total{phase="handler"} 20' in body
+
+
+def test_metrics_record_orm_queries(api, client, db, Author):
+    metrics = api.enable_metrics()
+    db.add_query_listener(metrics.observe_query)
+    db.create(Author)
+    db.save(Author(name="John", age=30))
+
+    assert 'tomapi_phase_calls_total{phase="orm"} 2' in client.get("http://testserver/metrics").text
+
+
+def test_profiler_captures_slow_requests_with_queries(api, client, db, Author):
+    profiler = api.enable_profiling(sample_rate=1, threshold=0)
+    db.add_query_listener(profiler.record_query)
+    db.create(Author)
+
+    @api.route("/authors/{id}")
+    def author(req, resp, id):
+        db.save(Author(name="John", age=30))
+        resp.text = db.get(Author, int(id)).name
+
+    client.get("http://testserver/authors/1")
+
+    captures = client.get("http://testserver/_profiler").json()
+
+    assert len(captures) == 1
+    assert captures[0]["route"] == "/authors/{id}"
+    assert captures[0]["method"] == "GET"
+    assert captures[0]["status"] == "200"
+    assert captures[0]["queries"][0]["sql"].startswith("INSERT INTO author")
+    assert "function calls" in captures[0]["profile"]
+
+
+def test_profiler_captures_are_json_safe_and_redacted(api, client, db):
+    class Attachment(Table):
+        data = Column(bytes)
+
+    profiler = api.enable_profiling(sample_rate=1, threshold=0, redact=False)
+    db.add_query_listener(profiler.record_query)
+    db.create(Attachment)
+
+    @api.route("/attachments")
+    def attachments(req, resp):
+        db.save(Attachment(data=b"\x00\xff"))
+        resp.text = "saved"
+
+    client.get("http://testserver/attachments")
+    captures = client.get("http://testserver/_profiler").json()
+    assert captures[0]["queries"][-1]["params"] == ["<2 bytes>"]
+
+    api.profiler.redact = True
+    client.get("http://testserver/attachments")
+    captures = client.get("http://testserver/_profiler").json()
+    assert captures[-1]["queries"][-1]["params"] == ["?"]
+
+
+def test_profiler_captures_can_require_authorization(api, client):
+    api.enable_profiling(authorize=lambda req: req.headers.get("X-Token") == "secret")
+
+    assert client.get("http://testserver/_profiler").status_code == 403
+    assert client.get("http://testserver/_profiler", headers={"X-Token": "secret"}).json() == []
+
+
+def test_profiler_samples_on_header_only(api, client):
+    profiler = api.enable_profiling(sample_rate=None, threshold=0, capacity=2)
+
+    @api.route("/")
+    def index(req, resp):
+        resp.text = "hey"
+
+    client.get("http://testserver/")
+    assert len(profiler.captures) == 0
+
+    for _ in range(3):
+        client.get("http://testserver/", headers={"X-Profile": "1"})
+    assert len(profiler.captures) == 2
+
+
+def test_query_log_reports_n_plus_one(api, client, db, Author, Book):
+    query_log = api.enable_query_log(n_plus_one_threshold=2, redact=True)
+    db.add_query_listener(query_log.record_query)
+    db.create(Author)
+    db.create(Book)
+    for name in ("John", "Arash", "Vic"):
+        author = Author(name=name, age=30)
+        db.save(author)
+        db.save(Book(title=f"{name}'s book", published=True, author=author))
+
+    @api.route("/books")
+    def books(req, resp):
+        resp.json = [book.author.name for book in db.all(Book)]
+
+    response = client.get("http://testserver/books")
+
+    assert response.json() == ["John", "Arash", "Vic"]
+    assert response.headers["X-Query-Count"] == "4"
+    assert response.headers["X-Query-N-Plus-One"].startswith("3x SELECT id, age, name FROM author")
+
+
+def test_query_log_flags_slow_queries(api, db, Author):
+    query_log = api.enable_query_log(slow_threshold=0, redact=lambda sql, params: ["***"])
+    db.add_query_listener(query_log.record_query)
+    db.create(Author)
+
+    query_log.begin()
+    db.save(Author(name="John", age=30))
+    queries = query_log.end()
+
+    assert len(queries) == 1
+    assert queries[0]["slow"] is True
+    assert queries[0]["params"] == ["***"]
+    assert queries[0]["rows"] == 1
+
+
+def _import_times(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_optional_dependencies_are_not_imported_on_startup():
+    times = _import_times("tomapi.api")
+
+    assert "tomapi.api" in times
+    for module in ("requests", "wsgiadapter", "jinja2", "whitenoise", "cProfile"):
+        assert module not in times
+
+
+def test_template_env_and_whitenoise_are_built_lazily(api):
+    assert api._template_env is None
+    assert api._whitenoise is None
+
+    api.template("index.html", context={"title": "Title", "name": "Name"})
+
+    assert api._template_env is not None
+    assert api._whitenoise is None
+
+
+def test_request_body_over_route_limit_is_rejected_early(api, client):
+    handler_called = False
+
+    @api.route("/upload", max_body_size=10)
+    def upload(req, resp):
+        nonlocal handler_called
+        handler_called = True
+
+    response = client.post("http://testserver/upload", data=b"x" * 11)
+
+    assert response.status_code == 413
+    assert handler_called is False
+    assert client.post("http://testserver/upload", data=b"x" * 10).status_code == 200
+
+
+def test_request_body_limit_is_enforced_while_streaming():
+    environ = {"wsgi.input": BytesIO(b"x" * 100), "wsgi.input_terminated": True}
+    body = RequestBody(environ, max_size=50, chunk_size=10)
+
+    with pytest.raises(RequestEntityTooLarge):
+        list(body.iter_chunks())
+
+
+def test_request_body_json_and_form(api, client):
+    @api.route("/json")
+    def json_handler(req, resp):
+        resp.json = req.payload.parse()
+
+    @api.route("/form")
+    def form_handler(req, resp):
+        resp.json = dict(req.payload.parse())
+
+    assert client.post("http://testserver/json", json={"a": [1, 2]}).json() == {"a": [1, 2]}
+    assert client.post("http://testserver/form", data={"a": "1", "b": ""}).json() == {"a": "1", "b": ""}
+
+
+def test_multipart_uploads_are_spooled():
+    api = API(spool_threshold=16)
+    client = api.test_session()
+
+    @api.route("/upload")
+    def upload(req, resp):
+        form = req.payload.parse()
+        upload = form["file"]
+        resp.json = {
+            "title": form["title"],
+            "filename": upload.filename,
+            "content_type": upload.content_type,
+            "size": upload.size,
+            "spooled": upload.file._rolled,
+            "content": upload.read().decode(),
+        }
+
+    content = "line\r\n" * 20000
+    response = client.post(
+        "http://testserver/upload",
+        data={"title": "Report"},
+        files={"file": ("report.txt", content, "text/plain")},
+    )
+
+    assert response.json() == {
+        "title": "Report",
+        "filename": "report.txt",
+        "content_type": "text/plain",
+        "size": len(content),
+        "spooled": True,
+        "content": content,
+    }
+
+
+def test_request_body_chunks(api, client):
+    @api.route("/chunks")
+    def chunks(req, resp):
+        resp.json = [len(chunk) for chunk in req.payload.iter_chunks(chunk_size=4)]
+
+    assert client.post("http://testserver/chunks", data=b"0123456789").json() == [4, 4, 2]
+
+
+def test_request_body_form_is_parsed_across_chunks():
+    data = "name=J%C3%B6rg&tags=a&tags=b+c&empty=".encode()
+    environ = {
+        "wsgi.input": BytesIO(data),
+        "CONTENT_LENGTH": str(len(data)),
+        "CONTENT_TYPE": "application/x-www-form-urlencoded",
+    }
+    form = RequestBody(environ, chunk_size=3).form()
+
+    assert list(form.items()) == [("name", "Jörg"), ("tags", "a"), ("tags", "b c"), ("empty", "")]
+
+
+def test_request_body_without_length_or_termination_is_rejected(api):
+    @api.route("/upload")
+    def upload(req, resp):
+        resp.body = req.payload.read()
+
+    request = Request.blank("/upload", method="POST", body=b"data")
+    del request.environ["CONTENT_LENGTH"]
+    request.environ["HTTP_TRANSFER_ENCODING"] = "chunked"
+    assert request.get_response(api).status_code == 411
+
+    request.environ["wsgi.input_terminated"] = True
+    request.environ["wsgi.input"] = BytesIO(b"data")
+    assert request.get_response(api).body == b"data"
+
+    assert Request.blank("/upload", method="POST").get_response(api).body == b""
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.001)
+
+
+def test_identical_concurrent_gets_are_coalesced(api):
+    executions = 0
+
+    @api.route("/report", coalesce=True)
+    def report(req, resp):
+        nonlocal executions
+        executions += 1
+        # Hold the execution until every other request is waiting on it
+        _wait_for(lambda: api.coalescer.coalesced == 4)
+        resp.json = {"executions": executions}
+
+    responses = []
+
+    def fetch():
+        responses.append(api.test_session().get("http://testserver/report?page=1"))
+
+    threads = [threading.Thread(target=fetch) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert executions == 1
+    assert [r.json() for r in responses] == [{"executions": 1}] * 5
+    assert api.coalescer.stats() == {"executions": 1, "coalesced": 4}
+
+
+def test_coalesced_responses_do_not_share_headers(api):
+    class SetCookieMiddleware(Middleware):
+        def process_response(self, req, resp):
+            resp.headers["Set-Cookie"] = req.headers["X-User"]
+
+    api.add_middleware(SetCookieMiddleware)
+
+    @api.route("/report", coalesce=True)
+    def report(req, resp):
+        _wait_for(lambda: api.coalescer.coalesced == 2)
+        resp.text = "report"
+
+    cookies = {}
+
+    def fetch(user):
+        response = api.test_session().get("http://testserver/report", headers={"X-User": user})
+        cookies[user] = response.headers["Set-Cookie"]
+
+    threads = [threading.Thread(target=fetch, args=(user,)) for user in ("a", "b", "c")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cookies == {"a": "a", "b": "b", "c": "c"}
+
+
+def test_coalescing_is_keyed_on_query_and_headers(api):
+    @api.route("/report", coalesce=["Accept-Language"])
+    def report(req, resp):
+        # Hold every execution open until all the requests have arrived
+        _wait_for(lambda: api.coalescer.executions == 3 and api.coalescer.coalesced == 1)
+        resp.text = req.headers["Accept-Language"] + req.query_string
+
+    requests_sent = [("fr", ""), ("de", ""), ("fr", "a=1"), ("fr", "")]
+    texts = [None] * len(requests_sent)
+
+    def fetch(index, language, query):
+        texts[index] = api.test_session().get(
+            f"http://testserver/report?{query}", headers={"Accept-Language": language}
+        ).text
+
+    threads = [
+        threading.Thread(target=fetch, args=(index, language, query))
+        for index, (language, query) in enumerate(requests_sent)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert texts == ["fr", "de", "fra=1", "fr"]
+    assert api.coalescer.stats() == {"executions": 3, "coalesced": 1}
+
+
+def test_single_flight_on_an_event_loop():
+    flight = SingleFlight()
+    executions = 0
+
+    async def load():
+        nonlocal executions
+        executions += 1
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("key", load) for _ in range(3)))
+
+    results = asyncio.run(main())
+
+    assert executions == 1
+    assert results == [("result", False), ("result", True), ("result", True)]
+    assert flight.stats() == {"executions": 1, "coalesced": 2}
+
+
+def test_response_headers(api, client):
+    @api.route("/headers")
+    def headers(req, resp):
+        resp.text = "hey"
+        resp.headers["X-Custom"] = "yes"
+
+    assert client.get("http://testserver/headers").headers["X-Custom"] == "yes"
+
+
+def test_admission_control_sheds_load_when_queue_is_full(api):
+    release = threading.Event()
+    api.enable_metrics()
+    api.add_middleware(AdmissionControlMiddleware, max_concurrency=1, max_queue=0, retry_after=5)
+
+    @api.route("/slow")
+    def slow(req, resp):
+        release.wait(5)
+        resp.text = "done"
+
+    responses = []
+    thread = threading.Thread(
+        target=lambda: responses.append(api.test_session().get("http://testserver/slow"))
+    )
+    thread.start()
+    _wait_for(lambda: api.metrics.render().count("tomapi_requests_in_flight 1") == 1)
+
+    rejected = api.test_session().get("http://testserver/slow")
+    release.set()
+    thread.join()
+
+    assert rejected.status_code == 503
+    assert rejected.headers["Retry-After"] == "5"
+    assert responses[0].text == "done"
+    body = api.test_session().get("http://testserver/metrics").text
+    assert 'tomapi_admission_rejections_total{reason="queue_full"} 1' in body
+    assert "tomapi_admission_queue_depth 0" in body
+
+
+def test_admission_control_routes_once_and_registers_gauge_after_middleware(api, client):
+    api.add_middleware(AdmissionControlMiddleware, route_limits={"/items/{id}": 2})
+    api.enable_metrics()
+
+    @api.route("/items/{id}")
+    def item(req, resp, id):
+        resp.text = id
+
+    lookups = []
+    find_handler = api.find_handler
+
+    def counting_find_handler(request_path):
+        lookups.append(request_path)
+        return find_handler(request_path)
+
+    api.find_handler = counting_find_handler
+
+    assert client.get("http://testserver/items/7").text == "7"
+    assert lookups == ["/items/7"]
+    assert "tomapi_admission_queue_depth 0" in client.get("http://testserver/metrics").text
+
+
+def test_admission_control_route_limit_times_out_queued_requests(api):
+    release = threading.Event()
+    api.add_middleware(AdmissionControlMiddleware, route_limits={"/slow": 1}, max_wait=0.05)
+
+    @api.route("/slow")
+    def slow(req, resp):
+        release.wait(5)
+
+    @api.route("/fast")
+    def fast(req, resp):
+        resp.text = "fast"
+
+    thread = threading.Thread(target=lambda: api.test_session().get("http://testserver/slow"))
+    thread.start()
+    _wait_for(lambda: api.middleware.app.route_limiters["/slow"].active == 1)
+
+    client = api.test_session()
+    queued = client.get("http://testserver/slow")
+    fast = client.get("http://testserver/fast")
+    release.set()
+    thread.join()
+
+    assert queued.status_code == 503
+    assert fast.text == "fast"
+    assert api.middleware.app.stats() == {
+        "queue_depth": 0,
+        "rejected": {"queue_full": 0, "timeout": 1, "expired": 0},
+    }
+
+
+def test_admission_control_route_queue_does_not_hold_global_slots(api):
+    release = threading.Event()
+    api.add_middleware(
+        AdmissionControlMiddleware, max_concurrency=3, route_limits={"/slow": 1}, max_wait=5
+    )
+
+    @api.route("/slow")
+    def slow(req, resp):
+        release.wait(5)
+
+    @api.route("/fast")
+    def fast(req, resp):
+        resp.text = "fast"
+
+    threads = [
+        threading.Thread(target=lambda: api.test_session().get("http://testserver/slow"))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    admission = api.middleware.app
+    _wait_for(lambda: admission.route_limiters["/slow"].waiting == 2)
+
+    start = time.monotonic()
+    fast = api.test_session().get("http://testserver/fast")
+    elapsed = time.monotonic() - start
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert fast.text == "fast"
+    assert elapsed < 0.5
+    assert admission.global_limiter.active == 0
+
+
+def test_admission_control_rejects_requests_queued_upstream_too_long(api, client):
+    api.add_middleware(AdmissionControlMiddleware, max_wait=1.0)
+
+    @api.route("/")
+    def index(req, resp):
+        resp.text = "hey"
+
+    stale = f"t={int((time.time() - 5) * 1000)}"
+    fresh = f"t={time.time()}"
+
+    assert client.get("http://testserver/", headers={"X-Request-Start": stale}).status_code == 503
+    assert client.get("http://testserver/", headers={"X-Request-Start": fresh}).text == "hey"
+
+
+def _process_handler(req, resp, n):
+    resp.json = {
+        "pid": os.getpid(),
+        "total": sum(range(int(n))),
+        "body": req.payload.read().decode(),
+    }
+
+
+def _sleeping_process_handler(req, resp):
+    time.sleep(30)
+
+
+def test_process_executor_runs_handler_in_another_process(api, client):
+    api.add_route("/sum/{n}", _process_handler, executor="process")
+
+    try:
+        response = client.post("http://testserver/sum/10", data=b"payload")
+    finally:
+        api.close()
+
+    assert response.json()["total"] == 45
+    assert response.json()["body"] == "payload"
+    assert response.json()["pid"] != os.getpid()
+
+
+def test_process_executor_streams_the_body_limit(api):
+    api.add_route("/sum/{n}", _process_handler, executor="process", max_body_size=100)
+
+    class CountingInput(BytesIO):
+        bytes_read = 0
+
+        def read(self, size=-1):
+            chunk = super().read(size)
+            CountingInput.bytes_read += len(chunk)
+            return chunk
+
+    request = Request.blank("/sum/10", method="POST")
+    request.environ.pop("CONTENT_LENGTH", None)
+    request.environ["HTTP_TRANSFER_ENCODING"] = "chunked"
+    request.environ["wsgi.input_terminated"] = True
+    request.environ["wsgi.input"] = CountingInput(b"x" * 5 * 1024 * 1024)
+
+    try:
+        response = request.get_response(api)
+    finally:
+        api.close()
+
+    assert response.status_code == 413
+    assert CountingInput.bytes_read <= 64 * 1024
+
+
+def test_process_executor_timeout():
+    api = API(process_pool_size=1)
+    client = api.test_session()
+    api.add_route("/sleep", _sleeping_process_handler, executor="process", timeout=0.1)
+    api.add_route("/sum/{n}", _process_handler, executor="process", timeout=10)
+
+    try:
+        response = client.get("http://testserver/sleep")
+        # The stuck worker is killed, so the next handler doesn't wait behind it
+        start = time.monotonic()
+        next_response = client.get("http://testserver/sum/10")
+        elapsed = time.monotonic() - start
+    finally:
+        api.close()
+
+    assert response.status_code == 504
+    assert next_response.json()["total"] == 45
+    assert elapsed < 10
+
+
+def test_warm_builds_templates_static_index_and_table_schemas(tmpdir_factory, Author):
+    static_dir = tmpdir_factory.mktemp("static")
+    _create_static(static_dir)
+    api = API(static_dir=str(static_dir))
+
+    api.warm()
+
+    assert len(api.template_env.cache) == len(api.template_env.list_templates())
+    assert api._whitenoise is not None
+    assert "_fields" in Author.__dict__
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_prefork_server_recycles_workers_and_stops_gracefully(tmpdir):
+    tmpdir.join("served_app.py").write(
+        "import os\n"
+        "from tomapi.api import API\n"
+        "app = API()\n"
+        "@app.route('/pid')\n"
+        "def pid(req, resp):\n"
+        "    resp.text = str(os.getpid())\n"
+    )
+    port = _free_port()
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "tomapi", "serve", "served_app:app",
+         "--bind", f"127.0.0.1:{port}", "--workers", "1", "--max-requests", "2"],
+        cwd=str(tmpdir),
+        env=env,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        assert b"Serving served_app:app" in server.stdout.readline()
+        pids = []
+        for _ in range(4):
+            for _ in range(50):
+                try:
+                    pids.append(requests.get(f"http://127.0.0.1:{port}/pid", timeout=5).text)
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.05)
+
+        assert len(pids) == 4
+        assert pids[0] == pids[1]
+        assert pids[2] == pids[3]
+        assert pids[1] != pids[2]
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=10) == 0
+
+
+def test_json_response_is_negotiated_as_msgpack(api, client):
+    msgpack = pytest.importorskip("msgpack")
+
+    @api.route("/data")
+    def data(req, resp):
+        resp.json = {"name": "tom", "tags": [1, 2]}
+
+    response = client.get("http://testserver/data", headers={"Accept": "application/msgpack"})
+
+    assert response.headers["Content-Type"] == "application/msgpack"
+    assert response.headers["Vary"] == "Accept"
+    assert msgpack.unpackb(response.content) == {"name": "tom", "tags": [1, 2]}
+    assert client.get("http://testserver/data").json() == {"name": "tom", "tags": [1, 2]}
+
+
+def test_json_response_is_negotiated_as_cbor(api, client):
+    cbor2 = pytest.importorskip("cbor2")
+
+    @api.route("/data")
+    def data(req, resp):
+        resp.json = {"name": "tom"}
+
+    response = client.get(
+        "http://testserver/data", headers={"Accept": "application/json;q=0.5, application/cbor"}
+    )
+
+    assert response.headers["Content-Type"] == "application/cbor"
+    assert cbor2.loads(response.content) == {"name": "tom"}
+
+
+def test_msgpack_request_body_is_decoded(api, client):
+    msgpack = pytest.importorskip("msgpack")
+
+    @api.route("/echo")
+    def echo(req, resp):
+        resp.json = req.payload.parse()
+
+    response = client.post(
+        "http://testserver/echo",
+        data=msgpack.packb({"a": [1, 2]}),
+        headers={"Content-Type": "application/msgpack", "Accept": "application/msgpack"},
+    )
+
+    assert msgpack.unpackb(response.content) == {"a": [1, 2]}
+
+
+def test_load_test_runs_a_weighted_mix_from_threads(api):
+    @api.route("/json")
+    def json_handler(req, resp):
+        resp.json = {"thread": threading.get_ident()}
+
+    @api.route("/echo", allowed_methods=["post"])
+    def echo(req, resp):
+        resp.text = req.payload.read().decode()
+        assert resp.text == "hello"
+
+    load_test = LoadTest(
+        api,
+        [
+            {"path": "/json", "weight": 3},
+            {"method": "POST", "path": "/echo", "body": b"hello"},
+            "/missing",
+        ],
+        concurrency=4,
+        requests=200,
+        seed=1,
+    )
+    result = load_test.run()
+
+    assert result.requests == 200
+    assert result.errors == 0
+    assert set(result.statuses) == {200, 404}
+    assert result.throughput > 0
+    assert 0 < result.percentile(50) <= result.percentile(95) <= result.percentile(99)
+    assert result.peak_memory > 0
+    assert "requests/s" in result.summary()
+
+
+def test_load_test_percentile_is_nearest_rank():
+    result = LoadTestResult([i / 1000 for i in range(1, 31)], {200: 30}, 0, 1.0, 1, None)
+
+    assert result.percentile(95) == 0.029
+    assert result.percentile(50) == 0.015
+    assert result.percentile(100) == 0.030
+
+
+def test_load_test_counts_handler_errors(api):
+    @api.route("/")
+    def index(req, resp):
+        raise ValueError("boom")
+
+    result = LoadTest(api, ["/"], concurrency=2, requests=10, measure_memory=False).run()
+
+    assert result.errors == 10
+    assert result.requests == 0
+    assert result.as_dict()["peak_memory_per_request"] is None
+
+
+def test_parse_mix_entry():
+    assert parse_mix_entry("/books") == {"method": "GET", "path": "/books", "weight": 1}
+    assert parse_mix_entry("POST:/books:3") == {"method": "POST", "path": "/books", "weight": 3}
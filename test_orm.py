@@ -1,6 +1,11 @@
+import os
 import sqlite3
+import time
 import pytest
 
+from tomapi.cache import QueryCache
+from tomapi.orm import Database
+
 
 def test_create_db(db):
     assert isinstance(db.conn, sqlite3.Connection)
@@ -157,3 +162,128 @@ def test_delete_author(db, Author):
 
     with pytest.raises(Exception):
         db.get(Author, 1)
+
+def test_get_returns_same_instance_within_session(db, Author):
+    db.create(Author)
+    db.save(Author(name="John", age=34))
+
+    with db.session():
+        first = db.get(Author, 1)
+        second = db.get(Author, 1)
+
+        assert first is second
+
+    with db.session():
+        assert db.get(Author, 1) is not first
+
+    assert db.identity_map is None
+    assert db.get(Author, 1) is not db.get(Author, 1)
+
+def test_get_outside_session_reads_the_database(db, Author):
+    db.create(Author)
+    john = Author(name="old", age=34)
+    db.save(john)
+    db.get(Author, 1)
+
+    other = Database("./test.db")
+    other.conn.execute("UPDATE author SET name = 'new' WHERE id = 1")
+    other.conn.commit()
+    john.name = "unsaved"
+
+    assert db.get(Author, 1).name == "new"
+    assert db.all(Author)[0].name == "new"
+
+def test_foreign_keys_share_one_instance(db, Author, Book):
+    db.create(Author)
+    db.create(Book)
+    john = Author(name="John", age=34)
+    db.save(john)
+    db.save(Book(title="First", published=True, author=john))
+    db.save(Book(title="Second", published=False, author=john))
+
+    books = db.all(Book)
+
+    assert books[0].author is books[1].author
+    assert books[0].author is not john
+
+def test_query_cache_hits_and_invalidation(Author):
+    if os.path.exists("./test.db"):
+        os.remove("./test.db")
+    cache = QueryCache(maxsize=10, ttl=60)
+    db = Database("./test.db", cache=cache)
+    db.create(Author)
+    john = Author(name="John", age=22)
+    db.save(john)
+
+    db.get(Author, john.id)
+    db.get(Author, john.id)
+
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_rate == 0.5
+
+    john.age = 23
+    db.update(john)
+
+    assert db.get(Author, john.id).age == 23
+
+def test_query_cache_evicts_least_recently_used():
+    cache = QueryCache(maxsize=2, ttl=None)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+def test_query_cache_is_shared_by_string_and_integer_ids(Author):
+    if os.path.exists("./test.db"):
+        os.remove("./test.db")
+    cache = QueryCache(maxsize=10, ttl=60)
+    db = Database("./test.db", cache=cache)
+    db.create(Author)
+    john = Author(name="John", age=1)
+    db.save(john)
+
+    assert db.get(Author, "1").age == 1
+    john.age = 2
+    db.update(john)
+    assert db.get(Author, "1").age == 2
+
+    db.delete(Author, 1)
+    with pytest.raises(Exception):
+        db.get(Author, "1")
+
+def test_query_cache_invalidated_by_delete(Author):
+    if os.path.exists("./test.db"):
+        os.remove("./test.db")
+    cache = QueryCache(maxsize=10, ttl=60)
+    db = Database("./test.db", cache=cache)
+    db.create(Author)
+    db.save(Author(name="John", age=22))
+    db.get(Author, 1)
+
+    db.delete(Author, "1")
+
+    assert cache.stats()["size"] == 0
+    with pytest.raises(Exception):
+        db.get(Author, 1)
+
+def test_query_cache_entries_expire_after_ttl(Author):
+    if os.path.exists("./test.db"):
+        os.remove("./test.db")
+    cache = QueryCache(maxsize=10, ttl=0.05)
+    db = Database("./test.db", cache=cache)
+    db.create(Author)
+    db.save(Author(name="old", age=22))
+    db.get(Author, 1)
+
+    other = Database("./test.db")
+    other.conn.execute("UPDATE author SET name = 'new' WHERE id = 1")
+    other.conn.commit()
+
+    assert db.get(Author, 1).name == "old"
+    time.sleep(0.1)
+    assert db.get(Author, 1).name == "new"
@@ -0,0 +1,152 @@
+import threading
+import time
+
+from .middleware import Middleware
+from .response import Response
+
+
+# A concurrency limit with a bounded queue of waiting requests
+class _Limiter:
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    # Returns None once admitted, or the reason the request was rejected
+    def acquire(self, deadline):
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return None
+            if self.waiting >= self.max_queue:
+                return "queue_full"
+
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return "timeout"
+                    self._condition.wait(remaining)
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+# Limits how many requests run at once, globally and per route. Requests over the
+# limit wait in a bounded queue and get a fast 503 when the queue is full or they
+# have waited longer than max_wait, counting time spent queued upstream.
+class AdmissionControlMiddleware(Middleware):
+    def __init__(
+        self,
+        app,
+        max_concurrency=None,
+        route_limits=None,
+        max_queue=100,
+        max_wait=1.0,
+        retry_after=1,
+        queue_start_header="X-Request-Start",
+    ):
+        super().__init__(app)
+        self.global_limiter = _Limiter(max_concurrency, max_queue) if max_concurrency else None
+        # Route paths as given to API.route -> concurrency limit
+        self.route_limiters = {
+            path: _Limiter(limit, max_queue) for path, limit in (route_limits or {}).items()
+        }
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.queue_start_key = (
+            "HTTP_" + queue_start_header.upper().replace("-", "_") if queue_start_header else None
+        )
+        self.rejected = {"queue_full": 0, "timeout": 0, "expired": 0}
+
+        # Routing happens in the API at the bottom of the middleware chain
+        self.api = app
+        while isinstance(self.api, Middleware):
+            self.api = self.api.app
+
+        # The queue depth gauge is registered on the first request seen with metrics
+        # enabled, so it doesn't matter whether enable_metrics is called before or after
+        self._gauge_registered = False
+
+    @property
+    def queue_depth(self):
+        depth = self.global_limiter.waiting if self.global_limiter is not None else 0
+        return depth + sum(limiter.waiting for limiter in self.route_limiters.values())
+
+    def stats(self):
+        return {"queue_depth": self.queue_depth, "rejected": dict(self.rejected)}
+
+    def handle_request(self, request):
+        if not self._gauge_registered and self.api.metrics is not None:
+            self.api.metrics.add_gauge("admission_queue_depth", lambda: self.queue_depth)
+            self._gauge_registered = True
+
+        queued = self._upstream_queue_time(request.environ)
+        if queued >= self.max_wait:
+            return self._reject(request, "expired")
+        deadline = time.monotonic() + self.max_wait - queued
+
+        # The route slot is taken first, so requests queued behind a slow route don't
+        # hold global slots that requests to other routes could use
+        limiters = []
+        if self.route_limiters:
+            # The API reuses this match instead of routing the request again
+            handler_data, _ = self.api.match_request(request)
+            if handler_data is not None and handler_data["path"] in self.route_limiters:
+                limiters.append(self.route_limiters[handler_data["path"]])
+        if self.global_limiter is not None:
+            limiters.append(self.global_limiter)
+
+        acquired = []
+        try:
+            for limiter in limiters:
+                reason = limiter.acquire(deadline)
+                if reason is not None:
+                    return self._reject(request, reason)
+                acquired.append(limiter)
+
+            return super().handle_request(request)
+        finally:
+            for limiter in acquired:
+                limiter.release()
+
+    # Seconds the request spent queued before it reached the worker, from a header
+    # such as "X-Request-Start: t=1690000000.123" set by the load balancer
+    def _upstream_queue_time(self, environ):
+        if self.queue_start_key is None:
+            return 0.0
+        value = environ.get(self.queue_start_key)
+        if not value:
+            return 0.0
+
+        try:
+            started = float(value.strip().lstrip("t="))
+        except ValueError:
+            return 0.0
+        # Proxies send seconds, milliseconds or microseconds since the epoch
+        if started > 1e14:
+            started /= 1e6
+        elif started > 1e11:
+            started /= 1e3
+
+        return max(0.0, time.time() - started)
+
+    def _reject(self, request, reason):
+        self.rejected[reason] += 1
+        if self.api.metrics is not None:
+            self.api.metrics.inc("admission_rejections_total", reason=reason)
+
+        response = Response()
+        response.status_code = 503
+        response.text = "Service Unavailable"
+        response.headers["Retry-After"] = str(self.retry_after)
+        return response
@@ -1,32 +1,141 @@
 from webob import Request
-from parse import parse
-from requests import Session as RequestsSession
-from wsgiadapter import WSGIAdapter as RequestsWSGIAdapter
-from jinja2 import Environment, FileSystemLoader
-from whitenoise import WhiteNoise
+from parse import compile as compile_route
 
+from .body import LengthRequired, RequestBody, RequestEntityTooLarge
+from .coalesce import SingleFlight
 from .middleware import Middleware
 from .response import Response
 
+import copy
 import inspect
 import os
+import threading
+import time
 
 
 class API:
-    def __init__(self, templates_dir="templates", static_dir="static"):
+    def __init__(
+        self,
+        templates_dir="templates",
+        static_dir="static",
+        max_body_size=None,
+        spool_threshold=1024 * 1024,
+        process_pool_size=None,
+    ):
         self.routes = {}
-        self.template_env = Environment(
-            loader=FileSystemLoader(os.path.abspath(templates_dir))
-        )
-        # The static file handler, by default all requests pass through this.
-        # Notice that the main wsgi_app handler is passed to this.
-        self.whitenoise = WhiteNoise(self.wsgi_app, root=static_dir)
+        # Workers for routes added with executor="process", defaults to one per CPU
+        self.process_pool_size = process_pool_size
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        # Default limit in bytes for request bodies, routes can override it
+        self.max_body_size = max_body_size
+        # Uploaded files larger than this many bytes are spooled to disk
+        self.spool_threshold = spool_threshold
+        self.templates_dir = os.path.abspath(templates_dir)
+        self.static_dir = static_dir
+        # Jinja and WhiteNoise are only imported and built once they are first needed,
+        # see the template_env and whitenoise properties
+        self._template_env = None
+        self._whitenoise = None
         self.exception_handler = None
         self.middleware = Middleware(self)
+        # Request instrumentation, off until enable_metrics is called
+        self.metrics = None
+        # Sampling profiler, off until enable_profiling is called
+        self.profiler = None
+        # SQL statement log with N+1 detection, off until enable_query_log is called
+        self.query_log = None
+        # Shared executions for routes added with coalesce
+        self.coalescer = SingleFlight()
+
+    @property
+    def template_env(self):
+        if self._template_env is None:
+            from jinja2 import Environment, FileSystemLoader
+
+            self._template_env = Environment(loader=FileSystemLoader(self.templates_dir))
+        return self._template_env
+
+    # The static file handler, by default all requests pass through this.
+    # Notice that the main wsgi_app handler is passed to this.
+    @property
+    def whitenoise(self):
+        if self._whitenoise is None:
+            from whitenoise import WhiteNoise
+
+            self._whitenoise = WhiteNoise(self.wsgi_app, root=self.static_dir)
+        return self._whitenoise
+
+    # Started the first time a route added with executor="process" is requested
+    @property
+    def process_pool(self):
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+
+                self._process_pool = ProcessPoolExecutor(max_workers=self.process_pool_size)
+            return self._process_pool
+
+    # Stop the worker processes, if they were started
+    def close(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+            self._process_pool = None
+
+    # Kill the workers of a pool that has a stuck handler, the next request starts a new pool.
+    # Handlers still running in the pool fail with BrokenProcessPool.
+    def _discard_process_pool(self, pool):
+        with self._process_pool_lock:
+            if self._process_pool is pool:
+                self._process_pool = None
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # Build everything that is otherwise built on first use, so that a prefork server
+    # can do it once before forking and share the result with its workers
+    def warm(self):
+        from .orm import Table
+
+        if os.path.isdir(self.templates_dir):
+            for template_name in self.template_env.list_templates():
+                self.template_env.get_template(template_name)
+
+        # WhiteNoise indexes the static files when it is created
+        if os.path.isdir(self.static_dir):
+            self.whitenoise
+
+        tables = Table.__subclasses__()
+        while tables:
+            table = tables.pop()
+            table._get_fields()
+            tables.extend(table.__subclasses__())
 
     # Per pep3333 all WSGI servers must be callable
     # We pass it to whitenoise so that static files can be processed
     def __call__(self, environ, start_response):
+        if self.profiler is not None and self.profiler.should_profile(environ):
+            return self.profiler.run(self._call, environ, start_response)
+
+        return self._call(environ, start_response)
+
+    def _call(self, environ, start_response):
+        if self.query_log is not None:
+            self.query_log.begin()
+            try:
+                return self._measure(environ, self.query_log.wrap_start_response(start_response))
+            finally:
+                self.query_log.end(environ)
+
+        return self._measure(environ, start_response)
+
+    def _measure(self, environ, start_response):
+        if self.metrics is not None:
+            return self._instrumented_call(environ, start_response)
+
+        return self._dispatch(environ, start_response)
+
+    def _dispatch(self, environ, start_response):
         path_info = environ["PATH_INFO"]
         if path_info.startswith("/static"):
             environ["PATH_INFO"] = path_info[len("/static") :]
@@ -34,6 +143,95 @@ class API:
 
         return self.middleware(environ, start_response)
 
+    # Same as _dispatch, but records latency, status and the time spent in each phase
+    def _instrumented_call(self, environ, start_response):
+        metrics = self.metrics
+        static = environ["PATH_INFO"].startswith("/static")
+        if static:
+            # Static files skip the middleware, which stores the status of other requests
+            statuses = []
+
+            def capture_status(status_line, headers, exc_info=None):
+                statuses.append(int(status_line[:3]))
+                return start_response(status_line, headers, exc_info)
+
+        metrics.request_started()
+        start = time.perf_counter()
+        try:
+            return self._dispatch(environ, capture_status if static else start_response)
+        finally:
+            duration = time.perf_counter() - start
+
+            if static:
+                route = "/static"
+                status = statuses[0] if statuses else 500
+            else:
+                route = environ.get("tomapi.route", "<unmatched>")
+                status = environ.get("tomapi.status", 500)
+            # Set by handle_request, missing for static files and requests answered by middleware
+            routing, handler = environ.get("tomapi.phases", (None, None))
+            metrics.request_finished(
+                route, environ["REQUEST_METHOD"], status, duration, routing, handler
+            )
+
+    # Turn on request instrumentation and expose it in the Prometheus text format on `path`
+    def enable_metrics(self, path="/metrics", buckets=None):
+        from .metrics import Metrics
+
+        self.metrics = Metrics(buckets=buckets)
+
+        def metrics_handler(request, response):
+            response.text = self.metrics.render()
+
+        self.add_route(path, metrics_handler, allowed_methods=["get"])
+        return self.metrics
+
+    # Profile 1 in sample_rate requests (and any request sending `header`) and keep
+    # the slow ones in a ring buffer that can be inspected on `path`
+    def enable_profiling(
+        self,
+        sample_rate=100,
+        header="X-Profile",
+        threshold=0.5,
+        capacity=50,
+        path="/_profiler",
+        redact=True,
+        authorize=None,
+    ):
+        from .profiler import Profiler
+
+        self.profiler = Profiler(
+            sample_rate=sample_rate,
+            header=header,
+            threshold=threshold,
+            capacity=capacity,
+            redact=redact,
+        )
+
+        # authorize(request) returns whether the request may read the captures
+        def profiler_handler(request, response):
+            if authorize is not None and not authorize(request):
+                response.status_code = 403
+                response.text = "Forbidden"
+                return
+            response.json = list(self.profiler.captures)
+
+        self.add_route(path, profiler_handler, allowed_methods=["get"])
+        return self.profiler
+
+    # Record the SQL statements of every request, flagging slow queries and N+1 patterns.
+    # Pass QueryLog.record_query to Database.add_query_listener to feed it.
+    def enable_query_log(self, slow_threshold=0.1, n_plus_one_threshold=3, redact=False, header=True):
+        from .querylog import QueryLog
+
+        self.query_log = QueryLog(
+            slow_threshold=slow_threshold,
+            n_plus_one_threshold=n_plus_one_threshold,
+            redact=redact,
+            header=header,
+        )
+        return self.query_log
+
     # The main request handler.
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
@@ -46,10 +244,17 @@ class API:
     def template(self, template_name, context=None):
         if context is None:
             context = {}
-        return self.template_env.get_template(template_name).render(**context)
+        if self.metrics is None:
+            return self.template_env.get_template(template_name).render(**context)
 
-    def add_middleware(self, middleware_class):
-        self.middleware.add(middleware_class)
+        start = time.perf_counter()
+        try:
+            return self.template_env.get_template(template_name).render(**context)
+        finally:
+            self.metrics.observe("template", time.perf_counter() - start)
+
+    def add_middleware(self, middleware_class, **options):
+        self.middleware.add(middleware_class, **options)
 
     # Allows capability to add a custom exception handler passed by reference
     def add_exception_handler(self, exception_handler):
@@ -57,28 +262,101 @@ class API:
 
     # To be used as a decorator to define different application routes
     # It behaves the same as add_route, but is a bit more fluent.
-    def route(self, path, allowed_methods=None):
+    def route(
+        self,
+        path,
+        allowed_methods=None,
+        max_body_size=None,
+        coalesce=False,
+        executor=None,
+        timeout=None,
+    ):
         def wrapper(handler):
-            self.add_route(path, handler, allowed_methods)
+            self.add_route(
+                path,
+                handler,
+                allowed_methods,
+                max_body_size=max_body_size,
+                coalesce=coalesce,
+                executor=executor,
+                timeout=timeout,
+            )
             return handler
 
         return wrapper
 
     # Add a route to the applications routes
     # this is the same as the "route" decorator method, and is more of a django approach
-    def add_route(self, path, handler, allowed_methods=None):
+    # coalesce is True or a list of header names that are part of what makes two GETs identical.
+    # executor="process" runs the handler in the process pool, giving up after timeout seconds.
+    def add_route(
+        self,
+        path,
+        handler,
+        allowed_methods=None,
+        max_body_size=None,
+        coalesce=False,
+        executor=None,
+        timeout=None,
+    ):
         assert path not in self.routes, "Route is already defined!"
+        assert executor in (None, "process"), "Unknown executor!"
 
         if allowed_methods is None:
             allowed_methods = ["get", "post", "put", "patch", "delete", "options"]
 
-        self.routes[path] = {"handler": handler, "allowed_methods": allowed_methods}
+        if coalesce is True:
+            coalesce = ()
+        elif not coalesce:
+            coalesce = None
+        else:
+            coalesce = tuple(coalesce)
+
+        self.routes[path] = {
+            "path": path,
+            "pattern": compile_route(path),
+            "handler": handler,
+            "allowed_methods": allowed_methods,
+            "max_body_size": max_body_size,
+            "coalesce": coalesce,
+            "executor": executor,
+            "timeout": timeout,
+        }
 
     # Handle the request
     def handle_request(self, request):
-        response = Response()
+        metrics = self.metrics
+
+        if metrics is not None:
+            start = time.perf_counter()
+
+        handler_data, kwargs = self.match_request(request)
+
+        if handler_data is not None:
+            request.environ["tomapi.route"] = handler_data["path"]
 
-        handler_data, kwargs = self.find_handler(request_path=request.path)
+        if metrics is not None:
+            routed = time.perf_counter()
+
+        try:
+            if (
+                handler_data is not None
+                and handler_data["coalesce"] is not None
+                and request.method == "GET"
+            ):
+                response = self._coalesced_handler_response(request, handler_data, kwargs)
+            else:
+                response = self._handler_response(request, handler_data, kwargs)
+        finally:
+            if metrics is not None:
+                # Recorded with the rest of the request in _instrumented_call
+                request.environ["tomapi.phases"] = (routed - start, time.perf_counter() - routed)
+
+        return response
+
+    # Run the handler and build its response
+    def _handler_response(self, request, handler_data, kwargs):
+        response = Response()
 
         try:
             if handler_data is not None:
@@ -93,9 +371,30 @@ class API:
                     if request.method.lower() not in allowed_methods:
                         raise AttributeError("Method not allowed", request.method)
 
-                handler(request, response, **kwargs)
+                max_body_size = handler_data["max_body_size"]
+                if max_body_size is None:
+                    max_body_size = self.max_body_size
+
+                # Reject oversized bodies before the handler runs when the length is announced
+                if max_body_size is not None and (request.content_length or 0) > max_body_size:
+                    self.request_too_large_response(response)
+                elif handler_data["executor"] == "process":
+                    response = self._process_handler_response(
+                        request, handler, kwargs, max_body_size, handler_data["timeout"]
+                    )
+                else:
+                    request.payload = RequestBody(
+                        request.environ,
+                        max_size=max_body_size,
+                        spool_threshold=self.spool_threshold,
+                    )
+                    handler(request, response, **kwargs)
             else:
                 self.default_response(response)
+        except RequestEntityTooLarge:
+            self.request_too_large_response(response)
+        except LengthRequired:
+            self.length_required_response(response)
         except Exception as e:
             if self.exception_handler is None:
                 raise e
@@ -104,10 +403,74 @@ class API:
 
         return response
 
+    # Run the handler in the process pool on a picklable copy of the request
+    def _process_handler_response(self, request, handler, kwargs, max_body_size, timeout):
+        from concurrent.futures import TimeoutError
+        from concurrent.futures.process import BrokenProcessPool
+        from .executor import run_handler, snapshot_request
+
+        # Streamed so that a body without Content-Length is rejected as soon as it crosses the limit
+        body = RequestBody(
+            request.environ, max_size=max_body_size, spool_threshold=self.spool_threshold
+        ).read()
+
+        pool = self.process_pool
+        response = Response()
+        try:
+            future = pool.submit(
+                run_handler,
+                handler,
+                snapshot_request(request, body),
+                kwargs,
+                max_body_size,
+                self.spool_threshold,
+            )
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            # A handler that already started can't be cancelled, it would keep its worker
+            # busy for good if it hangs
+            if not future.cancel():
+                self._discard_process_pool(pool)
+            self.gateway_timeout_response(response)
+            return response
+        except BrokenProcessPool:
+            # A worker died, or the pool was discarded after another handler timed out
+            self._discard_process_pool(pool)
+            self.service_unavailable_response(response)
+            return response
+
+    # Identical concurrent GETs wait for a single execution of the handler and share its response
+    def _coalesced_handler_response(self, request, handler_data, kwargs):
+        key = (
+            request.path,
+            request.query_string,
+            tuple(request.headers.get(header) for header in handler_data["coalesce"]),
+        )
+        response, shared = self.coalescer.do(
+            key, lambda: self._handler_response(request, handler_data, kwargs)
+        )
+
+        if shared and self.metrics is not None:
+            self.metrics.inc("coalesced_requests_total", route=handler_data["path"])
+
+        # Every request, the leader included, gets its own copy: rendering the body and
+        # middleware setting headers (such as Set-Cookie) mutate the response
+        response = copy.copy(response)
+        response.headers = dict(response.headers)
+        return response
+
+    # find_handler for a request, reusing the match of a middleware that already routed it
+    def match_request(self, request):
+        path = request.path
+        match = request.environ.get("tomapi.match")
+        if match is None or match[0] != path:
+            match = request.environ["tomapi.match"] = (path, *self.find_handler(request_path=path))
+        return match[1], match[2]
+
     # Find the handler defined by @app.route decorator
     def find_handler(self, request_path):
-        for path, handler_data in self.routes.items():
-            parse_result = parse(path, request_path)
+        for handler_data in self.routes.values():
+            parse_result = handler_data["pattern"].parse(request_path)
             if parse_result is not None:
                 return handler_data, parse_result.named
 
@@ -118,8 +481,27 @@ class API:
         response.status_code = 404
         response.text = "Not Found"
 
+    def gateway_timeout_response(self, response):
+        response.status_code = 504
+        response.text = "Gateway Timeout"
+
+    def service_unavailable_response(self, response):
+        response.status_code = 503
+        response.text = "Service Unavailable"
+
+    def length_required_response(self, response):
+        response.status_code = 411
+        response.text = "Length Required"
+
+    def request_too_large_response(self, response):
+        response.status_code = 413
+        response.text = "Request Entity Too Large"
+
     # Allows one to create a spoofed/mocked test server
     def test_session(self, base_url="http://testserver"):
+        from requests import Session as RequestsSession
+        from wsgiadapter import WSGIAdapter as RequestsWSGIAdapter
+
         session = RequestsSession()
         session.mount(prefix=base_url, adapter=RequestsWSGIAdapter(self))
         return session
@@ -0,0 +1,235 @@
+from email.message import Message
+from email.parser import BytesHeaderParser
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qsl
+import io
+import json
+import shutil
+
+from webob.multidict import MultiDict
+
+from .codecs import JSON, get_codec
+
+
+class RequestEntityTooLarge(Exception):
+    pass
+
+
+# The body has no Content-Length and the server doesn't mark where it ends
+class LengthRequired(Exception):
+    pass
+
+
+class UploadedFile:
+    def __init__(self, name, filename, content_type, file, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        # A SpooledTemporaryFile, rewound to the start
+        self.file = file
+        self.size = size
+
+    def read(self):
+        return self.file.read()
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self.file, f)
+
+
+# Streams the body of a request from wsgi.input without loading it all at once.
+# The body can only be consumed once, through one of the methods below.
+class RequestBody:
+    # Multipart part headers larger than this are rejected
+    MAX_PART_HEADER_SIZE = 16 * 1024
+
+    def __init__(self, environ, max_size=None, spool_threshold=1024 * 1024, chunk_size=64 * 1024):
+        self.environ = environ
+        self.max_size = max_size
+        # Uploads bigger than this are written to a temporary file instead of memory
+        self.spool_threshold = spool_threshold
+        self.chunk_size = chunk_size
+        self.consumed = False
+        self._content_type_header = None
+
+    # The Content-Type header is only parsed when a handler looks at the body
+    @property
+    def _parsed_content_type(self):
+        if self._content_type_header is None:
+            self._content_type_header = Message()
+            self._content_type_header["content-type"] = (
+                self.environ.get("CONTENT_TYPE") or "application/octet-stream"
+            )
+        return self._content_type_header
+
+    @property
+    def content_type(self):
+        return self._parsed_content_type.get_content_type()
+
+    @property
+    def charset(self):
+        return self._parsed_content_type.get_param("charset") or "utf-8"
+
+    @property
+    def boundary(self):
+        return self._parsed_content_type.get_param("boundary")
+
+    @property
+    def content_length(self):
+        value = self.environ.get("CONTENT_LENGTH")
+        if not value:
+            return None
+        return int(value)
+
+    # Yields the raw body chunk by chunk, raising RequestEntityTooLarge past max_size
+    # and LengthRequired when the end of the body can't be found
+    def iter_chunks(self, chunk_size=None):
+        if self.consumed:
+            raise RuntimeError("The request body has already been consumed")
+        self.consumed = True
+
+        chunk_size = chunk_size or self.chunk_size
+        stream = self.environ["wsgi.input"]
+        remaining = self.content_length
+        if remaining is None and not self.environ.get("wsgi.input_terminated"):
+            # Without a length the input can only be read safely when the server terminates it.
+            # A request with neither a length nor a Transfer-Encoding has no body.
+            if self.environ.get("HTTP_TRANSFER_ENCODING"):
+                raise LengthRequired()
+            return
+        if remaining is not None and self.max_size is not None and remaining > self.max_size:
+            raise RequestEntityTooLarge(remaining)
+
+        read = 0
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            read += len(chunk)
+            if self.max_size is not None and read > self.max_size:
+                raise RequestEntityTooLarge(read)
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    def read(self):
+        buffer = bytearray()
+        for chunk in self.iter_chunks():
+            buffer += chunk
+        return bytes(buffer)
+
+    def json(self):
+        return json.loads(self.read().decode(self.charset))
+
+    def form(self):
+        if self.content_type == "multipart/form-data":
+            return self.multipart()
+
+        # Fields are parsed as they stream in, only the last incomplete one is buffered
+        form = MultiDict()
+        buffer = bytearray()
+        for chunk in self.iter_chunks():
+            buffer += chunk
+            end = buffer.rfind(b"&")
+            if end >= 0:
+                form.extend(parse_qsl(buffer[:end].decode(self.charset), keep_blank_values=True))
+                del buffer[: end + 1]
+        form.extend(parse_qsl(buffer.decode(self.charset), keep_blank_values=True))
+        return form
+
+    # Decode the body according to its content type: JSON, MessagePack, CBOR, forms or raw bytes
+    def parse(self):
+        content_type = self.content_type
+        if content_type == JSON:
+            return self.json()
+        if content_type in ("application/x-www-form-urlencoded", "multipart/form-data"):
+            return self.form()
+        codec = get_codec(content_type)
+        if codec is not None:
+            return codec[1](self.read())
+        return self.read()
+
+    # Parse a multipart/form-data body as it streams in. Fields are returned as str,
+    # files as UploadedFile instances spooled to disk above spool_threshold.
+    def multipart(self):
+        if not self.boundary:
+            raise ValueError("Missing multipart boundary")
+
+        delimiter = b"\r\n--" + self.boundary.encode("latin-1")
+        form = MultiDict()
+        chunks = self.iter_chunks()
+        # The leading CRLF lets the first boundary match the same delimiter as the others
+        buffer = bytearray(b"\r\n")
+        eof = False
+
+        def fill():
+            nonlocal eof
+            try:
+                buffer.extend(next(chunks))
+            except StopIteration:
+                eof = True
+
+        # Skip the preamble
+        while True:
+            index = buffer.find(delimiter)
+            if index >= 0:
+                del buffer[: index + len(delimiter)]
+                break
+            if eof:
+                raise ValueError("Malformed multipart body")
+            del buffer[: max(0, len(buffer) - len(delimiter))]
+            fill()
+
+        while True:
+            while len(buffer) < 2 and not eof:
+                fill()
+            if buffer[:2] == b"--":
+                break
+            if buffer[:2] != b"\r\n":
+                raise ValueError("Malformed multipart body")
+            del buffer[:2]
+
+            while True:
+                index = buffer.find(b"\r\n\r\n")
+                if index >= 0:
+                    break
+                if eof or len(buffer) > self.MAX_PART_HEADER_SIZE:
+                    raise ValueError("Malformed multipart body")
+                fill()
+            headers = BytesHeaderParser().parsebytes(bytes(buffer[: index + 4]))
+            del buffer[: index + 4]
+
+            name = headers.get_param("name", header="content-disposition")
+            filename = headers.get_filename()
+            if filename is None:
+                target = io.BytesIO()
+            else:
+                target = SpooledTemporaryFile(max_size=self.spool_threshold)
+
+            size = 0
+            while True:
+                index = buffer.find(delimiter)
+                if index >= 0:
+                    target.write(buffer[:index])
+                    size += index
+                    del buffer[: index + len(delimiter)]
+                    break
+                if eof:
+                    raise ValueError("Malformed multipart body")
+                # Keep enough bytes to match a delimiter split across chunks
+                keep = len(delimiter) - 1
+                if len(buffer) > keep:
+                    target.write(buffer[:-keep])
+                    size += len(buffer) - keep
+                    del buffer[:-keep]
+                fill()
+
+            if filename is None:
+                form.add(name, target.getvalue().decode(self.charset))
+            else:
+                target.seek(0)
+                content_type = headers.get_content_type() if "content-type" in headers else None
+                form.add(name, UploadedFile(name, filename, content_type, target, size))
+
+        return form
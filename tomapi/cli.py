@@ -0,0 +1,91 @@
+import argparse
+import json
+import sys
+
+
+def serve(args):
+    from .server import PreforkServer
+
+    host, _, port = args.bind.rpartition(":")
+    server = PreforkServer(
+        args.app,
+        host=host or "127.0.0.1",
+        port=int(port),
+        workers=args.workers,
+        max_requests=args.max_requests,
+        reuse_port=args.reuse_port,
+        graceful_timeout=args.graceful_timeout,
+        access_log=args.access_log,
+    )
+    server.run()
+
+
+# "METHOD:/path:weight", the method and weight are optional ("/path", "POST:/path", "/path:3")
+def parse_mix_entry(value):
+    parts = value.split(":")
+    method = "GET"
+    weight = 1
+    if parts[0] and not parts[0].startswith("/"):
+        method = parts.pop(0)
+    if len(parts) > 1 and parts[-1].isdigit():
+        weight = int(parts.pop())
+    return {"method": method, "path": ":".join(parts), "weight": weight}
+
+
+def loadtest(args):
+    from .loadtest import LoadTest
+    from .server import load_app
+
+    result = LoadTest(
+        load_app(args.app),
+        [parse_mix_entry(value) for value in args.request or ["/"]],
+        concurrency=args.concurrency,
+        requests=args.requests,
+        duration=args.duration,
+        warmup=args.warmup,
+        measure_memory=not args.no_memory,
+    ).run()
+
+    if args.json:
+        print(json.dumps(result.as_dict(), indent=2))
+    else:
+        print(result.summary())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tomapi")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="serve an app with the prefork server")
+    serve_parser.add_argument("app", help="the app to serve, as module:attribute")
+    serve_parser.add_argument("-b", "--bind", default="127.0.0.1:8000", help="host:port to listen on")
+    serve_parser.add_argument("-w", "--workers", type=int, default=None, help="defaults to one per CPU")
+    serve_parser.add_argument(
+        "--max-requests", type=int, default=0, help="replace a worker after this many requests, 0 never does"
+    )
+    serve_parser.add_argument("--reuse-port", action="store_true", help="give every worker its own SO_REUSEPORT socket")
+    serve_parser.add_argument("--graceful-timeout", type=float, default=30)
+    serve_parser.add_argument("--access-log", action="store_true")
+    serve_parser.set_defaults(func=serve)
+
+    loadtest_parser = commands.add_parser("loadtest", help="measure an app's throughput in-process")
+    loadtest_parser.add_argument("app", help="the app to load, as module:attribute")
+    loadtest_parser.add_argument(
+        "-r", "--request", action="append", help="METHOD:/path:weight to send, repeat for a mix"
+    )
+    loadtest_parser.add_argument("-c", "--concurrency", type=int, default=8, help="number of threads")
+    loadtest_parser.add_argument("-n", "--requests", type=int, default=1000)
+    loadtest_parser.add_argument("-d", "--duration", type=float, default=None, help="run for seconds instead")
+    loadtest_parser.add_argument("--warmup", type=int, default=10)
+    loadtest_parser.add_argument("--no-memory", action="store_true", help="skip measuring peak memory")
+    loadtest_parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    loadtest_parser.set_defaults(func=loadtest)
+
+    args = parser.parse_args(argv)
+    # Allow "module:app" to refer to modules in the current directory
+    sys.path.insert(0, "")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Runs a function once for every group of concurrent callers using the same key.
+# Callers arriving while it runs wait for it and share its result (or exception).
+class SingleFlight:
+    def __init__(self):
+        self.executions = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    # Returns (result, shared), shared is True when another caller's execution was reused
+    def do(self, key, func):
+        leader = False
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+            else:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result, False
+
+    # Same as do for asyncio code, coroutine_function is awaited once per group of callers.
+    # All callers must run on the same event loop.
+    async def do_async(self, key, coroutine_function):
+        import asyncio
+
+        future = self._futures.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), True
+
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        self.executions += 1
+        try:
+            result = await coroutine_function()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Make sure the exception is not reported as never retrieved when nobody waited
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._futures[key]
+
+        return result, False
+
+    def stats(self):
+        return {"executions": self.executions, "coalesced": self.coalesced}
@@ -0,0 +1,65 @@
+from webob.acceptparse import create_accept_header
+import json
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+# Other names clients use for the same formats
+ALIASES = {
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+}
+
+
+def _json_codec():
+    return (lambda data: json.dumps(data).encode("UTF-8"), lambda body: json.loads(body))
+
+
+def _msgpack_codec():
+    import msgpack
+
+    return (msgpack.packb, msgpack.unpackb)
+
+
+def _cbor_codec():
+    import cbor2
+
+    return (cbor2.dumps, cbor2.loads)
+
+
+# Formats in order of preference when the client accepts several equally.
+# MessagePack and CBOR are optional, they are available when msgpack or cbor2 is installed.
+_LOADERS = {JSON: _json_codec, MSGPACK: _msgpack_codec, CBOR: _cbor_codec}
+_codecs = {}
+
+
+# Returns (encode, decode) for a content type, or None when it is unknown or not installed
+def get_codec(content_type):
+    content_type = ALIASES.get(content_type, content_type)
+    if content_type not in _codecs:
+        loader = _LOADERS.get(content_type)
+        try:
+            _codecs[content_type] = loader() if loader is not None else None
+        except ImportError:
+            _codecs[content_type] = None
+    return _codecs[content_type]
+
+
+def available_content_types():
+    return [content_type for content_type in _LOADERS if get_codec(content_type) is not None]
+
+
+# Pick the format to encode data with from an Accept header, JSON unless the client prefers another one
+def negotiate(accept):
+    if not accept or accept == "*/*":
+        return JSON
+
+    offers = available_content_types()
+    if offers == [JSON]:
+        return JSON
+    aliases = [alias for alias, content_type in ALIASES.items() if content_type in offers]
+    acceptable = create_accept_header(accept).acceptable_offers(offers + aliases)
+    if not acceptable:
+        return JSON
+    return ALIASES.get(acceptable[0][0], acceptable[0][0])
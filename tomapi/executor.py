@@ -0,0 +1,31 @@
+from io import BytesIO
+
+from webob import Request
+
+from .body import RequestBody
+from .response import Response
+
+
+# A picklable copy of a request: its string environ entries and its body, already read
+def snapshot_request(request, body):
+    environ = {
+        key: value for key, value in request.environ.items() if isinstance(value, str)
+    }
+    return environ, body
+
+
+def restore_request(snapshot, max_body_size=None, spool_threshold=1024 * 1024):
+    environ, body = snapshot
+    environ = dict(environ, **{"wsgi.input": BytesIO(body), "CONTENT_LENGTH": str(len(body))})
+    request = Request(environ)
+    request.payload = RequestBody(environ, max_size=max_body_size, spool_threshold=spool_threshold)
+    return request
+
+
+# Runs in a worker process. The handler must be importable (defined at module
+# level) and whatever it sets on the response must be picklable.
+def run_handler(handler, snapshot, kwargs, max_body_size=None, spool_threshold=1024 * 1024):
+    request = restore_request(snapshot, max_body_size, spool_threshold)
+    response = Response()
+    handler(request, response, **kwargs)
+    return response
@@ -0,0 +1,217 @@
+from io import BytesIO
+import math
+import random
+import threading
+import time
+import tracemalloc
+
+from webob import Request
+
+
+class LoadTestResult:
+    def __init__(self, latencies, statuses, errors, duration, concurrency, peak_memory):
+        self.latencies = sorted(latencies)
+        # status code -> count
+        self.statuses = statuses
+        # Requests that raised instead of returning a response
+        self.errors = errors
+        self.duration = duration
+        self.concurrency = concurrency
+        # Mean peak of the memory traced while handling one request, above what was
+        # traced before it, in bytes. None when not measured.
+        self.peak_memory = peak_memory
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        return self.requests / self.duration if self.duration else 0.0
+
+    # Nearest-rank percentile of the request latencies, in seconds
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        index = max(0, min(len(self.latencies) - 1, math.ceil(percent / 100 * len(self.latencies)) - 1))
+        return self.latencies[index]
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "concurrency": self.concurrency,
+            "duration": self.duration,
+            "throughput": self.throughput,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "statuses": dict(self.statuses),
+            "peak_memory_per_request": self.peak_memory,
+        }
+
+    def summary(self):
+        lines = [
+            f"Requests:      {self.requests} ({self.errors} errors) with {self.concurrency} threads",
+            f"Duration:      {self.duration:.3f}s",
+            f"Throughput:    {self.throughput:.1f} requests/s",
+            "Latency:       p50 {:.3f}ms  p95 {:.3f}ms  p99 {:.3f}ms".format(
+                self.percentile(50) * 1000, self.percentile(95) * 1000, self.percentile(99) * 1000
+            ),
+            "Statuses:      " + ", ".join(f"{status}: {count}" for status, count in sorted(self.statuses.items())),
+        ]
+        if self.peak_memory is not None:
+            lines.append(f"Peak memory:   {self.peak_memory / 1024:.1f} KiB per request")
+        return "\n".join(lines)
+
+
+# Drives a WSGI app directly from several threads, without sockets or an HTTP client.
+#
+# mix is a list of requests to pick from, either paths or dicts with "path" and
+# optionally "method", "body", "headers" and "weight" (how often it is picked).
+class LoadTest:
+    def __init__(
+        self,
+        app,
+        mix,
+        concurrency=8,
+        requests=1000,
+        duration=None,
+        warmup=10,
+        measure_memory=True,
+        seed=None,
+    ):
+        self.app = app
+        self.mix = [self._prepare(entry) for entry in mix]
+        self.weights = [entry["weight"] for entry in self.mix]
+        self.concurrency = concurrency
+        # Stop after this many requests, or after duration seconds when given
+        self.requests = requests
+        self.duration = duration
+        # Requests sent before measuring, to fill caches and compile templates
+        self.warmup = warmup
+        self.measure_memory = measure_memory
+        self.seed = seed
+
+    def _prepare(self, entry):
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        request = Request.blank(
+            entry["path"],
+            method=entry.get("method", "GET").upper(),
+            headers=entry.get("headers"),
+            POST=entry.get("body"),
+        )
+        body = request.body
+        environ = {key: value for key, value in request.environ.items() if key != "wsgi.input"}
+        return {"environ": environ, "body": body, "weight": entry.get("weight", 1)}
+
+    # Send one request and return its status code
+    def _send(self, entry):
+        environ = dict(entry["environ"])
+        environ["wsgi.input"] = BytesIO(entry["body"])
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line[:3]))
+
+        result = self.app(environ, start_response)
+        try:
+            for _ in result:
+                pass
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return status[0]
+
+    def _pick(self, rng):
+        if len(self.mix) == 1:
+            return self.mix[0]
+        return rng.choices(self.mix, weights=self.weights)[0]
+
+    def run(self):
+        rng = random.Random(self.seed)
+        for _ in range(self.warmup):
+            try:
+                self._send(self._pick(rng))
+            except Exception:
+                # Failures are counted in the measured run
+                pass
+
+        peak_memory = self._measure_peak_memory(rng) if self.measure_memory else None
+
+        latencies = []
+        statuses = {}
+        errors = 0
+        lock = threading.Lock()
+        remaining = [self.requests]
+        deadline = None
+
+        def take():
+            if deadline is not None:
+                return time.perf_counter() < deadline
+            with lock:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+                return True
+
+        def worker(seed):
+            nonlocal errors
+            rng = random.Random(seed)
+            local_latencies = []
+            local_statuses = {}
+            local_errors = 0
+            while take():
+                entry = self._pick(rng)
+                start = time.perf_counter()
+                try:
+                    status = self._send(entry)
+                except Exception:
+                    local_errors += 1
+                    continue
+                local_latencies.append(time.perf_counter() - start)
+                local_statuses[status] = local_statuses.get(status, 0) + 1
+
+            with lock:
+                latencies.extend(local_latencies)
+                for status, count in local_statuses.items():
+                    statuses[status] = statuses.get(status, 0) + count
+                errors += local_errors
+
+        threads = [
+            threading.Thread(target=worker, args=(rng.random(),)) for _ in range(self.concurrency)
+        ]
+        start = time.perf_counter()
+        if self.duration is not None:
+            deadline = start + self.duration
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        return LoadTestResult(latencies, statuses, errors, elapsed, self.concurrency, peak_memory)
+
+    # Mean of the peak memory traced while handling a request, measured serially
+    # before the timed run because tracing slows every allocation down
+    def _measure_peak_memory(self, rng, samples=20):
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start()
+        try:
+            total = 0
+            for _ in range(samples):
+                entry = self._pick(rng)
+                tracemalloc.reset_peak()
+                baseline, _ = tracemalloc.get_traced_memory()
+                try:
+                    self._send(entry)
+                except Exception:
+                    pass
+                _, peak = tracemalloc.get_traced_memory()
+                total += peak - baseline
+            return total / samples
+        finally:
+            if not already_tracing:
+                tracemalloc.stop()
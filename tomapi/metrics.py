@@ -0,0 +1,205 @@
+from bisect import bisect_left
+import threading
+import weakref
+
+
+# Counters written by a single thread. Every thread gets its own shard so
+# recording never takes a lock, the shards are only summed when rendered.
+class _Shard:
+    def __init__(self, bucket_count):
+        self.bucket_count = bucket_count
+        # (route, method, status) -> [count per bucket..., +Inf count, seconds,
+        # routing seconds, handler seconds, middleware seconds, requests with phases]
+        self.requests = {}
+        # phase -> [total seconds, count]
+        self.phases = {}
+        # (name, labels) -> value
+        self.counters = {}
+        self.in_flight = 0
+
+    # Add the counts of another shard to this one
+    def merge(self, other):
+        for key, record in list(other.requests.items()):
+            total = self.requests.get(key)
+            if total is None:
+                self.requests[key] = list(record)
+            else:
+                for i, value in enumerate(record):
+                    total[i] += value
+        for phase, (seconds, count) in list(other.phases.items()):
+            total = self.phases.setdefault(phase, [0.0, 0])
+            total[0] += seconds
+            total[1] += count
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.in_flight += other.in_flight
+
+
+# Kept in the thread-local next to a shard, it is freed when its thread ends
+class _ShardOwner:
+    pass
+
+
+class Metrics:
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._local = threading.local()
+        self._shards = set()
+        # Counts of the threads that have ended, folded into one shard
+        self._retired = _Shard(len(self.buckets) + 1)
+        self._shards_lock = threading.Lock()
+        # name -> callable returning the current value
+        self._gauges = {}
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = _Shard(len(self.buckets) + 1)
+            with self._shards_lock:
+                self._shards.add(shard)
+            owner = _ShardOwner()
+            # Fold the shard into the retired counts once the thread is gone, so servers
+            # starting a thread per request don't keep a shard for every request
+            weakref.finalize(owner, self._retire, shard).atexit = False
+            self._local.shard = shard
+            self._local.owner = owner
+            return shard
+
+    def _retire(self, shard):
+        with self._shards_lock:
+            self._shards.discard(shard)
+            self._retired.merge(shard)
+
+    def request_started(self):
+        self._shard().in_flight += 1
+
+    # Record a request that request_started was called for, duration is in seconds.
+    # routing and handler are the seconds spent in those phases, the rest of the
+    # duration is counted as middleware.
+    def request_finished(self, route, method, status, duration, routing=None, handler=None):
+        shard = self._shard()
+        shard.in_flight -= 1
+
+        key = (route, method, status)
+        record = shard.requests.get(key)
+        if record is None:
+            record = shard.requests[key] = [0] * shard.bucket_count + [0.0, 0.0, 0.0, 0.0, 0]
+        record[bisect_left(self.buckets, duration)] += 1
+        record[-5] += duration
+        if routing is not None:
+            record[-4] += routing
+            record[-3] += handler
+            record[-2] += duration - routing - handler
+            record[-1] += 1
+
+    # Record time spent in one phase of a request (routing, handler, template, orm...)
+    def observe(self, phase, duration):
+        _add_phase(self._shard().phases, phase, duration)
+
+    # Query listener for tomapi.orm.Database.add_query_listener
+    def observe_query(self, sql, params, duration, rowcount):
+        self.observe("orm", duration)
+
+    # Increment a free-form counter, rendered as tomapi_<name>
+    def inc(self, name, amount=1, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        shard.counters[key] = shard.counters.get(key, 0) + amount
+
+    # Register a gauge, func is called for its current value whenever metrics are rendered
+    def add_gauge(self, name, func):
+        self._gauges[name] = func
+
+    def _collect(self):
+        bucket_count = len(self.buckets) + 1
+        with self._shards_lock:
+            total = _Shard(bucket_count)
+            total.merge(self._retired)
+            for shard in self._shards:
+                total.merge(shard)
+
+        # route -> [count per bucket..., +Inf count, sum]
+        latency = {}
+        # (route, method, status) -> count
+        requests = {}
+        phases = total.phases
+        for key, record in total.requests.items():
+            histogram = latency.setdefault(key[0], [0] * bucket_count + [0.0])
+            for i in range(bucket_count + 1):
+                histogram[i] += record[i]
+            requests[key] = sum(record[:bucket_count])
+
+            if record[-1]:
+                for phase, seconds in zip(("routing", "handler", "middleware"), record[-4:-1]):
+                    phase_total = phases.setdefault(phase, [0.0, 0])
+                    phase_total[0] += seconds
+                    phase_total[1] += record[-1]
+
+        return latency, requests, phases, total.counters, total.in_flight
+
+    # Render every metric in the Prometheus text exposition format
+    def render(self):
+        latency, requests, phases, counters, in_flight = self._collect()
+        lines = []
+
+        lines.append("# HELP tomapi_request_duration_seconds Request latency by route.")
+        lines.append("# TYPE tomapi_request_duration_seconds histogram")
+        for route, histogram in sorted(latency.items()):
+            label = f'route="{_escape(route)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(f'tomapi_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += histogram[-2]
+            lines.append(f'tomapi_request_duration_seconds_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"tomapi_request_duration_seconds_sum{{{label}}} {histogram[-1]}")
+            lines.append(f"tomapi_request_duration_seconds_count{{{label}}} {cumulative}")
+
+        lines.append("# HELP tomapi_requests_total Requests by route, method and status.")
+        lines.append("# TYPE tomapi_requests_total counter")
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append(
+                f'tomapi_requests_total{{route="{_escape(route)}",method="{method}",status="{status}"}} {count}'
+            )
+
+        lines.append("# HELP tomapi_requests_in_flight Requests currently being handled.")
+        lines.append("# TYPE tomapi_requests_in_flight gauge")
+        lines.append(f"tomapi_requests_in_flight {in_flight}")
+
+        lines.append("# HELP tomapi_phase_seconds_total Time spent in each phase of request handling.")
+        lines.append("# TYPE tomapi_phase_seconds_total counter")
+        for phase, (seconds, _) in sorted(phases.items()):
+            lines.append(f'tomapi_phase_seconds_total{{phase="{phase}"}} {seconds}')
+        lines.append("# HELP tomapi_phase_calls_total Number of times each phase ran.")
+        lines.append("# TYPE tomapi_phase_calls_total counter")
+        for phase, (_, count) in sorted(phases.items()):
+            lines.append(f'tomapi_phase_calls_total{{phase="{phase}"}} {count}')
+
+        seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE tomapi_{name} counter")
+            label = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels)
+            lines.append(f"tomapi_{name}{{{label}}} {value}" if label else f"tomapi_{name} {value}")
+
+        for name, func in sorted(self._gauges.items()):
+            lines.append(f"# TYPE tomapi_{name} gauge")
+            lines.append(f"tomapi_{name} {func()}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _add_phase(phases, phase, seconds):
+    totals = phases.get(phase)
+    if totals is None:
+        totals = phases[phase] = [0.0, 0]
+    totals[0] += seconds
+    totals[1] += 1
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -7,10 +7,14 @@ class Middleware:
     def __call__(self, environ, start_response):
         request = Request(environ)
         response = self.app.handle_request(request)
-        return response(environ, start_response)
+        result = response(environ, start_response)
+        # The status that was sent, read by the API's metrics
+        environ["tomapi.status"] = response.status_code
+        return result
 
-    def add(self, middleware_class):
-        self.app = middleware_class(self.app)
+    # Extra options are passed on to the middleware's constructor
+    def add(self, middleware_class, **options):
+        self.app = middleware_class(self.app, **options)
 
     def process_request(self, request):
         pass
@@ -1,66 +1,167 @@
+from contextlib import contextmanager
 import sqlite3
 import inspect
+import time
 
 
 class Database:
-    def __init__(self, path):
+    def __init__(self, path, cache=None):
         self.conn = sqlite3.Connection(path)
+        # Optional cross-request cache of raw rows, see tomapi.cache.QueryCache
+        self.cache = cache
+        # One instance per (table, id) while a session is open, see session()
+        self.identity_map = None
+        self.query_listeners = []
 
     @property
     def tables(self):
         SELECT_TABLES_SQL = "SELECT name from sqlite_master WHERE type = 'table';"
-        return [x[0] for x in self.conn.execute(SELECT_TABLES_SQL).fetchall()]
+        return [x[0] for x in self._execute(SELECT_TABLES_SQL, fetch="all")]
+
+    # Listeners are called as listener(sql, params, duration, rowcount) after every statement
+    def add_query_listener(self, listener):
+        self.query_listeners.append(listener)
+
+    # Every statement goes through here so that listeners can time and record it.
+    # fetch is None (return the cursor), "one" or "all" (return the fetched rows).
+    def _execute(self, sql, params=(), fetch=None):
+        if not self.query_listeners:
+            cursor = self.conn.execute(sql, params)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+            return cursor
+
+        start = time.perf_counter()
+        cursor = self.conn.execute(sql, params)
+        if fetch == "one":
+            result = cursor.fetchone()
+            rowcount = 0 if result is None else 1
+        elif fetch == "all":
+            result = cursor.fetchall()
+            rowcount = len(result)
+        else:
+            result = cursor
+            rowcount = cursor.rowcount
+        duration = time.perf_counter() - start
+
+        for listener in self.query_listeners:
+            listener(sql, params, duration, rowcount)
+
+        return result
+
+    # A unit of work: inside it, get and all return the same instance for each (table, id)
+    # and get answers rows already loaded without querying again. Outside a session every
+    # call reads the database (or the cache) and builds new instances.
+    @contextmanager
+    def session(self):
+        previous = self.identity_map
+        self.identity_map = {}
+        try:
+            yield self
+        finally:
+            self.identity_map = previous
 
     def delete(self, table, id):
+        id = _normalize_id(id)
         sql, params = table._get_delete_sql(id)
-        self.conn.execute(sql, params)
+        self._execute(sql, params)
         self.conn.commit()
+        if self.identity_map is not None:
+            self.identity_map.pop((table, id), None)
+        self._invalidate(table, id)
+
     def save(self, instance):
         sql, values = instance._get_insert_sql()
-        cursor = self.conn.execute(sql, values)
+        cursor = self._execute(sql, values)
         instance._data["id"] = cursor.lastrowid
         self.conn.commit()
-
+        if self.identity_map is not None:
+            self.identity_map[(instance.__class__, instance.id)] = instance
+        self._invalidate(instance.__class__, instance.id)
 
     def create(self, table):
-        self.conn.execute(table._get_create_sql())
+        self._execute(table._get_create_sql())
 
     def all(self, table):
         sql, fields = table._get_select_all_sql()
 
+        # Rows loaded by this call share their foreign key instances even outside a session
+        identity_map = self._identity_map()
         result = []
-        for row in self.conn.execute(sql).fetchall():
-            instance = table()
-            for field, value in zip(fields, row):
-                if field.endswith('_id'):
-                    field = field[:-3]
-                    fk = getattr(table, field)
-                    value = self.get(fk.table, id=value)
-                setattr(instance, field, value)
-            result.append(instance)
+        for row in self._execute(sql, fetch="all"):
+            result.append(self._load(table, fields, row, identity_map))
 
         return result
-    
+
     def get(self, table, id):
+        return self._get(table, _normalize_id(id), self._identity_map())
+
+    def _identity_map(self):
+        if self.identity_map is not None:
+            return self.identity_map
+        return {}
+
+    def _get(self, table, id, identity_map):
+        instance = identity_map.get((table, id))
+        if instance is not None:
+            return instance
+
         sql, fields, params = table._get_select_where_sql(id=id)
 
-        row = self.conn.execute(sql, params).fetchone()
+        row = None
+        if self.cache is not None:
+            row = self.cache.get(self._cache_key(table, id))
         if row is None:
-            raise Exception(f"{table.__name__} instance with {id} does not exist")
+            row = self._execute(sql, params, fetch="one")
+            if row is None:
+                raise Exception(f"{table.__name__} instance with {id} does not exist")
+            if self.cache is not None:
+                self.cache.set(self._cache_key(table, id), row)
+
+        return self._load(table, fields, row, identity_map)
+
+    def update(self, instance):
+        sql, values = instance._get_update_sql()
+        self._execute(sql, values)
+        self.conn.commit()
+        self._invalidate(instance.__class__, instance.id)
+
+    # Build an instance from a row, reusing the one already in the identity map.
+    # The instance is registered before foreign keys are resolved so that
+    # rows referencing each other don't recurse forever.
+    def _load(self, table, fields, row, identity_map):
+        key = (table, row[0])
+        instance = identity_map.get(key)
+        if instance is not None:
+            return instance
 
         instance = table()
+        identity_map[key] = instance
         for field, value in zip(fields, row):
             if field.endswith('_id'):
                 field = field[:-3]
                 fk = getattr(table, field)
-                value = self.get(fk.table, id=value)
+                value = self._get(fk.table, value, identity_map)
             setattr(instance, field, value)
 
         return instance
-    def update(self, instance):
-        sql, values = instance._get_update_sql()
-        self.conn.execute(sql, values)
-        self.conn.commit()
+
+    def _cache_key(self, table, id):
+        return (table.__name__.lower(), id)
+
+    def _invalidate(self, table, id):
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key(table, id))
+
+# Route parameters arrive as strings while ids are stored as integers, so "1" and 1
+# must share the same identity map and cache entries
+def _normalize_id(id):
+    if isinstance(id, str) and id.isdigit():
+        return int(id)
+    return id
+
 
 class Table:
     def __init__(self, **kwargs):
@@ -68,6 +169,17 @@ class Table:
 
         for key, value in kwargs.items():
             self._data[key]=  value
+    # The Column and ForeignKey attributes of the table, looked up once per class
+    @classmethod
+    def _get_fields(cls):
+        if "_fields" not in cls.__dict__:
+            cls._fields = [
+                (name, field)
+                for name, field in inspect.getmembers(cls)
+                if isinstance(field, (Column, ForeignKey))
+            ]
+        return cls._fields
+
     @classmethod
     def _get_delete_sql(cls, id):
         DELETE_SQL = 'DELETE FROM {name} WHERE id = ?'
@@ -79,7 +191,7 @@ class Table:
     def _get_select_where_sql(cls, id):
         SELECT_WHERE_SQL = "SELECT {fields} FROM {name} WHERE id = ?;"
         fields = ["id"]
-        for name, field in inspect.getmembers(cls):
+        for name, field in cls._get_fields():
             if isinstance(field, Column):
                 fields.append(name)
             if isinstance(field, ForeignKey):
@@ -95,7 +207,7 @@ class Table:
         CREATE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS {name} ({fields})"
         fields = ["id INTEGER PRIMARY KEY AUTOINCREMENT"]
 
-        for name, field in inspect.getmembers(cls):
+        for name, field in cls._get_fields():
             if isinstance(field, Column):
                 fields.append(f"{name} {field.sql_type}")
             elif isinstance(field, ForeignKey):
@@ -111,7 +223,7 @@ class Table:
         SELECT_ALL_SQL = "SELECT {fields} from {name};"
 
         fields = ['id']
-        for name, field in inspect.getmembers(cls):
+        for name, field in cls._get_fields():
             if isinstance(field, Column):
                 fields.append(name)
             if isinstance(field, ForeignKey):
@@ -129,7 +241,7 @@ class Table:
         fields = []
         values = []
 
-        for name, field in inspect.getmembers(cls):
+        for name, field in cls._get_fields():
             if isinstance(field, Column):
                 fields.append(name)
                 values.append(getattr(self, name))
@@ -153,7 +265,7 @@ class Table:
         placeholders = []
         values = []
 
-        for name, field in inspect.getmembers(cls):
+        for name, field in cls._get_fields():
             if isinstance(field, Column):
                 fields.append(name)
                 values.append(getattr(self, name))
@@ -0,0 +1,116 @@
+from collections import deque
+import cProfile
+import io
+import itertools
+import pstats
+import threading
+import time
+
+from .querylog import redact_params
+
+
+class Profiler:
+    def __init__(
+        self,
+        sample_rate=100,
+        header="X-Profile",
+        threshold=0.5,
+        capacity=50,
+        sort="cumulative",
+        limit=40,
+        redact=True,
+    ):
+        # Profile one request out of every sample_rate, None profiles only on header
+        self.sample_rate = sample_rate
+        # Requests sending this header are always profiled and captured
+        self.header_key = "HTTP_" + header.upper().replace("-", "_") if header else None
+        # Sampled requests slower than this many seconds are captured
+        self.threshold = threshold
+        self.sort = sort
+        self.limit = limit
+        # Captures are served over HTTP, so SQL parameters are hidden unless redact is
+        # False or a callable(sql, params) returning the params to keep
+        self.redact = redact
+        # Oldest captures are dropped once the buffer is full
+        self.captures = deque(maxlen=capacity)
+        self._counter = itertools.count(1)
+        self._local = threading.local()
+
+    def should_profile(self, environ):
+        if self.header_key is not None and self.header_key in environ:
+            return True
+        if self.sample_rate:
+            return next(self._counter) % self.sample_rate == 0
+        return False
+
+    # Query listener for tomapi.orm.Database.add_query_listener, only records
+    # statements that run while a request is being profiled on this thread
+    def record_query(self, sql, params, duration, rowcount):
+        queries = getattr(self._local, "queries", None)
+        if queries is not None:
+            params = redact_params(self.redact, sql, list(params))
+            queries.append(
+                {
+                    "sql": sql,
+                    "params": [_json_safe(value) for value in params],
+                    "duration": duration,
+                    "rows": rowcount,
+                }
+            )
+
+    # Run a WSGI call under cProfile and capture it if it was slow or explicitly requested
+    def run(self, app, environ, start_response):
+        status = []
+
+        def capture_status(status_line, headers, exc_info=None):
+            status.append(status_line[:3])
+            return start_response(status_line, headers, exc_info)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            return app(environ, start_response)
+
+        forced = self.header_key is not None and self.header_key in environ
+        method = environ["REQUEST_METHOD"]
+        path = environ["PATH_INFO"]
+        self._local.queries = []
+        start = time.perf_counter()
+        try:
+            return app(environ, capture_status)
+        finally:
+            duration = time.perf_counter() - start
+            profile.disable()
+            queries = self._local.queries
+            self._local.queries = None
+
+            if forced or duration >= self.threshold:
+                self.captures.append(
+                    {
+                        "timestamp": time.time(),
+                        "route": environ.get("tomapi.route"),
+                        "method": method,
+                        "path": path,
+                        "status": status[0] if status else "500",
+                        "duration": duration,
+                        "queries": queries,
+                        "profile": self._format(profile),
+                    }
+                )
+
+    def _format(self, profile):
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats(self.sort).print_stats(self.limit)
+        return stream.getvalue()
+
+
+# Captures are served as JSON, BLOB parameters are summarised and anything else unusual is repr'd
+def _json_safe(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
@@ -0,0 +1,106 @@
+import logging
+import threading
+
+logger = logging.getLogger("tomapi.orm")
+
+
+# redact is True to hide every parameter, a callable(sql, params) returning the params
+# to keep, or False to keep them all
+def redact_params(redact, sql, params):
+    if redact is True:
+        return ["?"] * len(params)
+    if callable(redact):
+        return redact(sql, params)
+    return params
+
+
+class QueryLog:
+    def __init__(self, slow_threshold=0.1, n_plus_one_threshold=3, redact=False, header=True):
+        # Statements slower than this many seconds are flagged and logged
+        self.slow_threshold = slow_threshold
+        # The same statement run with this many different parameters in one request is an N+1
+        self.n_plus_one_threshold = n_plus_one_threshold
+        # True hides every parameter, a callable(sql, params) returns the params to keep
+        self.redact = redact
+        # Report the query count, total time and N+1 patterns in X-Query-* response headers
+        self.header = header
+        self._local = threading.local()
+
+    # Statements recorded so far for the request running on this thread
+    @property
+    def queries(self):
+        return getattr(self._local, "queries", None)
+
+    def begin(self):
+        self._local.queries = []
+
+    def end(self, environ=None):
+        queries = self._local.queries
+        self._local.queries = None
+
+        for sql, count in self.find_n_plus_one(queries):
+            logger.warning(
+                "N+1 query on %s %s: %s ran %d times",
+                environ["REQUEST_METHOD"] if environ else "-",
+                environ["PATH_INFO"] if environ else "-",
+                sql,
+                count,
+            )
+
+        return queries
+
+    # Query listener for tomapi.orm.Database.add_query_listener
+    def record_query(self, sql, params, duration, rowcount):
+        slow = duration >= self.slow_threshold
+        if slow:
+            logger.warning("Slow query (%.3fs): %s", duration, sql)
+
+        queries = self.queries
+        if queries is None:
+            return
+
+        queries.append(
+            {
+                "sql": sql,
+                "params": self._redact(sql, list(params)),
+                # Lets N+1 detection tell parameters apart after they were redacted
+                "params_hash": hash(repr(params)),
+                "duration": duration,
+                "rows": rowcount,
+                "slow": slow,
+            }
+        )
+
+    def _redact(self, sql, params):
+        return redact_params(self.redact, sql, params)
+
+    # Statements that ran with at least n_plus_one_threshold different parameters, as (sql, count) pairs
+    def find_n_plus_one(self, queries):
+        distinct = {}
+        for query in queries:
+            distinct.setdefault(query["sql"], set()).add(query["params_hash"])
+
+        counts = {}
+        for query in queries:
+            counts[query["sql"]] = counts.get(query["sql"], 0) + 1
+
+        return [
+            (sql, counts[sql])
+            for sql, params in distinct.items()
+            if len(params) >= self.n_plus_one_threshold
+        ]
+
+    # Wrap a WSGI start_response so the query summary is added to the response headers
+    def wrap_start_response(self, start_response):
+        if not self.header:
+            return start_response
+
+        def start_response_with_queries(status, headers, exc_info=None):
+            queries = self.queries or []
+            headers.append(("X-Query-Count", str(len(queries))))
+            headers.append(("X-Query-Time", "%.6f" % sum(q["duration"] for q in queries)))
+            for sql, count in self.find_n_plus_one(queries):
+                headers.append(("X-Query-N-Plus-One", f"{count}x {sql}"))
+            return start_response(status, headers, exc_info)
+
+        return start_response_with_queries
@@ -1,5 +1,6 @@
 from webob import Response as WebObResponse
-import json
+
+from .codecs import get_codec, negotiate
 
 
 class Response:
@@ -10,20 +11,27 @@ class Response:
         self.content_type = None
         self.body = b""
         self.status_code = 200
+        self.headers = {}
 
     def __call__(self, environment, start_response):
-        self.set_body_and_content_type()
+        self.set_body_and_content_type(accept=environment.get("HTTP_ACCEPT"))
 
         response = WebObResponse(
             body=self.body, content_type=self.content_type, status=self.status_code
         )
+        if self.headers:
+            response.headers.update(self.headers)
 
         return response(environment, start_response)
 
-    def set_body_and_content_type(self):
+    # response.json is encoded as JSON, or as MessagePack or CBOR when the Accept header prefers them
+    def set_body_and_content_type(self, accept=None):
         if self.json is not None:
-            self.body = json.dumps(self.json).encode("UTF-8")
-            self.content_type = "application/json"
+            content_type = negotiate(accept)
+            encode, _ = get_codec(content_type)
+            self.body = encode(self.json)
+            self.content_type = content_type
+            self.headers.setdefault("Vary", "Accept")
 
         if self.html is not None:
             self.body = self.html.encode()
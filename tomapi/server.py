@@ -0,0 +1,219 @@
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+import gc
+import importlib
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+
+# Loads "module:attribute", for example "app:app"
+def load_app(app_path):
+    module_name, _, attribute = app_path.partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute or "app")
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _WorkerServer(WSGIServer):
+    handled = 0
+
+    def process_request(self, request, client_address):
+        super().process_request(request, client_address)
+        self.handled += 1
+
+
+# Pre-forking WSGI server. The master imports and warms the app once, then forks
+# workers that share it copy-on-write. Workers are replaced after max_requests
+# requests, SIGHUP reloads the app without dropping connections and SIGTERM or
+# SIGINT shut everything down gracefully.
+class PreforkServer:
+    def __init__(
+        self,
+        app_path,
+        host="127.0.0.1",
+        port=8000,
+        workers=None,
+        max_requests=0,
+        reuse_port=False,
+        graceful_timeout=30,
+        backlog=2048,
+        access_log=False,
+    ):
+        self.app_path = app_path
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        # Every worker listens on its own SO_REUSEPORT socket and the kernel balances between them
+        self.reuse_port = reuse_port
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.access_log = access_log
+
+        self.app = None
+        self.socket = None
+        # pid -> generation, a reload starts a new generation
+        self.children = {}
+        self.generation = 0
+        self._stopping = False
+        self._reloading = False
+
+    def load(self):
+        if self.app is not None:
+            # Reload the module the app lives in, and nothing else
+            module_name = self.app_path.partition(":")[0]
+            importlib.reload(sys.modules[module_name])
+        self.app = load_app(self.app_path)
+        self.app.warm()
+        # Keep the garbage collector from touching (and so copying) objects shared with the workers
+        gc.collect()
+        gc.freeze()
+
+    def _listen(self, listen=True):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        if listen:
+            sock.listen(self.backlog)
+        return sock
+
+    def run(self):
+        self.load()
+        # With SO_REUSEPORT the master only holds the port, a listening socket
+        # would get its share of the connections without ever accepting them
+        self.socket = self._listen(listen=not self.reuse_port)
+        # Port 0 picks a free port, workers using SO_REUSEPORT must bind to the same one
+        self.port = self.socket.getsockname()[1]
+
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+
+        print(f"Serving {self.app_path} on http://{self.host}:{self.port} with {self.workers} workers")
+        self._spawn_workers()
+
+        while not self._stopping:
+            if self._reloading:
+                self._reloading = False
+                self._reload()
+            self._reap()
+            self._spawn_workers()
+            time.sleep(0.1)
+
+        self._shutdown()
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    # Start the new generation before stopping the old one, so requests keep being served
+    def _reload(self):
+        old = [pid for pid, generation in self.children.items() if generation == self.generation]
+        try:
+            gc.unfreeze()
+            self.load()
+        except Exception as e:
+            print(f"Reload failed, keeping the current workers: {e!r}", file=sys.stderr)
+            return
+        self.generation += 1
+        self._spawn_workers()
+        for pid in old:
+            self._kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            self.children.pop(pid, None)
+
+    def _spawn_workers(self):
+        running = sum(1 for generation in self.children.values() if generation == self.generation)
+        for _ in range(self.workers - running):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    self._work()
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    os._exit(code)
+            self.children[pid] = self.generation
+
+    def _shutdown(self):
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGKILL)
+        self._reap()
+        self.socket.close()
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self.children.pop(pid, None)
+
+    # The worker loop: serve until max_requests is reached or SIGTERM asks to stop,
+    # always finishing the request in progress
+    def _work(self):
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # Ctrl+C reaches the whole process group, the master decides what happens
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        sock = self.socket
+        if self.reuse_port:
+            sock = self._listen()
+            self.socket.close()
+        # Workers sharing a socket all wake up for a connection, the ones that lose
+        # the race to accept it must not block
+        sock.setblocking(False)
+
+        handler = WSGIRequestHandler if self.access_log else _QuietRequestHandler
+        server = _WorkerServer((self.host, self.port), handler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.server_name = socket.getfqdn(self.host)
+        server.server_port = self.port
+        server.setup_environ()
+        server.set_app(self.app)
+        # Wake up regularly to notice SIGTERM and a master that went away
+        server.timeout = 0.5
+
+        master = os.getppid()
+        while not stopping and os.getppid() == master:
+            if self.max_requests and server.handled >= self.max_requests:
+                break
+            server.handle_request()
+
+        sock.close()